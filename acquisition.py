@@ -0,0 +1,106 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file acquisition.py
+#  @brief Oximeter drivers and headless acquisition threads
+#**************************************************************************
+
+#!/usr/bin/env python3
+import cms50v45
+import cms50v46
+import config
+import session
+import pipeline
+import samplebus
+import supervisor
+from enum import Enum
+from threading import Thread
+
+
+class OximeterVersion(Enum):
+    FOURFIVE = 0
+    FOURSIX = 1
+    END = 3
+
+
+""" Create the driver of an oximeter firmware version, reading with a strategy of serialio.readStrategies (the configured one by default) """
+def createDriver(version, strategy=None):
+    if version == OximeterVersion.FOURFIVE:
+        return cms50v45.CMS50DDriver(strategy)
+    return cms50v46.CMS50DDriver(strategy)
+
+
+""" Parse a PORT[:v4.5|v4.6] device argument """
+def parseDevice(argument):
+    port, separator, versionName = argument.rpartition(':')
+    if separator and versionName in ('v4.5', 'v4.6'):
+        return port, OximeterVersion.FOURFIVE if versionName == 'v4.5' else OximeterVersion.FOURSIX
+    return argument, OximeterVersion.FOURSIX
+
+
+""" Record the samples of one oximeter into a session, without any UI """
+class DeviceReader(Thread):
+    def __init__(self, port, version, name=None):
+        Thread.__init__(self)
+        self.port = port
+        self.deviceName = name if name is not None else port
+        self.oximeter = createDriver(version)
+        self.error = None  # exception that stopped the acquisition
+        try:
+            self.oximeter.connect(port)
+        except Exception as e:
+            self.error = e  # no signal until the supervisor opens the port
+        self.threadActive = self.oximeter.isConnected() or config.autoReconnect
+        self.session = session.Session(version.value, self.oximeter.sampleRate, session.defaultSessionPath(self.deviceName) if config.recordSession else None)
+        sinks = [pipeline.Sink('session', self.session.appendRecords, config.sessionQueueSize, pipeline.QueuePolicy.BLOCK),
+                 pipeline.Sink('recorder', self.session.writeRecords, config.recorderQueueSize, pipeline.QueuePolicy.BLOCK)]
+        self.bus = None
+        if config.sampleBus:
+            busSink, self.bus = samplebus.createSink(self.deviceName, self.oximeter)
+            sinks.append(busSink)
+        self.supervisor = supervisor.supervise(self.oximeter, port, lambda: self.threadActive)
+        self.pipeline = pipeline.Pipeline(self.supervisor, sinks)
+
+    """ Health of the stream, see sampleclock.RateHealth """
+    def getHealth(self):
+        return self.oximeter.rateMeter.getHealth()
+
+    def run(self):
+        error = self.pipeline.run(lambda: self.threadActive)
+        if error is not None:
+            self.error = error
+        self.session.close()
+        if self.bus is not None:
+            self.bus.close()
+        self.oximeter.disconnect()
+        self.threadActive = False
+
+    def stop(self):
+        self.threadActive = False
+        self.join()
+
+
+""" Launcher: measure the end-to-end sample latency of a device with each read strategy """
+if __name__ == "__main__":
+    import time
+    import argparse
+    import serialio
+    parser = argparse.ArgumentParser(description='Measure the sample latency of an oximeter with each serial read strategy')
+    parser.add_argument('device', type=parseDevice, help='serial port, optionally suffixed by the firmware version (e.g. COM3:v4.5), v4.6 by default')
+    parser.add_argument('--strategy', action='append', choices=sorted(serialio.readStrategies), help='strategy to measure, all by default')
+    parser.add_argument('--seconds', type=float, default=10.0, help='duration of the measure of each strategy')
+    args = parser.parse_args()
+    port, version = args.device
+    for name in args.strategy or sorted(serialio.readStrategies):
+        driver = createDriver(version, name)
+        driver.connect(port)
+        end = time.monotonic() + args.seconds
+        sink = pipeline.Sink(name, lambda records: None, config.sessionQueueSize, pipeline.QueuePolicy.BLOCK)
+        pipeline.Pipeline(supervisor.supervise(driver, port, lambda: time.monotonic() < end), [sink]).run(lambda: time.monotonic() < end)
+        driver.disconnect()
+        print('{0}: latency mean {mean:.1f} ms, median {median:.1f} ms, p99 {p99:.1f} ms, peak {peak:.1f} ms - {1} frames, {2} reads ({3:.1f} bytes per read)'.format(
+            name, driver.stats.frames, driver.stats.reads, driver.stats.bytes / max(1, driver.stats.reads), **sink.latency.getMetrics()))
@@ -0,0 +1,202 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file analyze.py
+#  @brief Summaries of recorded sessions, batch analysis of an archive
+#
+#  Sessions are read through their memory map and analyzed with NumPy in a
+#  pool of processes. Summaries are cached in a JSON file per directory,
+#  keyed by the hash of the session file and analysisVersion: only new or
+#  modified sessions are analyzed again. Bump analysisVersion whenever the
+#  summary changes.
+#      py analyze.py sessions --jobs 8 --csv summary.csv
+#**************************************************************************
+
+#!/usr/bin/env python3
+import os
+import sys
+import json
+import hashlib
+import argparse
+import numpy
+import config
+import codec
+import session
+from session import ReaderEvent
+from concurrent.futures import ProcessPoolExecutor
+
+# version of the summary, part of the cache key
+analysisVersion = 2
+# name of the cache file, in the analyzed directory
+cacheFileName = '.analysis_cache.json'
+
+
+""" Return the [start, end) sample ranges where SpO2 stays desaturationDrop below the mean of the baseline window before it """
+def getDesaturations(spO2s, rate):
+    window = max(1, int(config.desaturationBaseline * rate))
+    minLength = max(1, int(config.desaturationMinDuration * rate))
+    if len(spO2s) <= window:
+        return []
+    sums = numpy.concatenate(([0], numpy.cumsum(spO2s, dtype=numpy.int64)))
+    baselines = (sums[window:-1] - sums[:-window - 1]) / window  # mean of the window before each sample
+    below = spO2s[window:] <= baselines - config.desaturationDrop
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate(([0], below.astype(numpy.int8), [0]))))
+    return [(start + window, end + window) for start, end in zip(edges[::2], edges[1::2]) if end - start >= minLength]
+
+
+""" Summary of a session (Session or SessionReader), over the samples without finger out / probe error """
+def getSummary(source):
+    rate = source.getSampleRate()
+    summary = dict(sampleCount=len(source), sampleRate=rate, duration=len(source) / rate)
+    summary['startTime'] = getattr(source, 'startTime', None)
+    flags = numpy.asarray(source.flags)
+    valid = (flags & (session.flagFingerOut | session.flagProbeError)) == 0
+    spO2s = numpy.asarray(source.spO2s)[valid]
+    pulseRates = numpy.asarray(source.pulseRates)[valid]
+    summary['validDuration'] = len(spO2s) / rate
+    if len(spO2s):
+        summary.update(minSpO2=int(spO2s.min()), meanSpO2=float(spO2s.mean()), maxSpO2=int(spO2s.max()))
+        summary.update(minPulse=int(pulseRates.min()), meanPulse=float(pulseRates.mean()), maxPulse=int(pulseRates.max()))
+        for threshold in sorted(set(config.analysisSpO2Thresholds + [config.spO2AlarmThreshold])):
+            summary['timeBelow{0}'.format(threshold)] = int(numpy.count_nonzero(spO2s < threshold)) / rate
+        desaturations = getDesaturations(spO2s, rate)
+        summary['desaturationCount'] = len(desaturations)
+        summary['odi'] = len(desaturations) / (summary['validDuration'] / 3600)
+    events = source.getEvents()
+    summary['holds'] = [(end[1] - start[1]) / 1e9 for start, end in session.getHolds(events)]
+    summary['holdCount'] = len(summary['holds'])
+    summary['longestHold'] = max(summary['holds']) if summary['holds'] else 0.0
+    summary['contractionCount'] = len([event for event in events if event[2] == ReaderEvent.CONTRACTION.value])
+    gaps = source.getGaps()
+    summary['gapCount'] = len(gaps)
+    summary['missingSamples'] = sum(gap[1] for gap in gaps)
+    summary['gapDuration'] = sum(gap[2] for gap in gaps) / 1e9
+    return summary
+
+
+""" Hash of a file content """
+def hashFile(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+""" Worker: summary of a session file, None if it can't be read (the readers raise ValueError on a corrupt file) """
+def analyzeFile(path, fileHash):
+    try:
+        reader = codec.openSession(path)
+    except (OSError, ValueError):
+        return path, fileHash, None
+    try:
+        summary = getSummary(reader)
+    finally:
+        reader.close()
+    return path, fileHash, summary
+
+
+""" Session cache of a directory: summaries by hash, and the hash of every file by path, size and mtime """
+class AnalysisCache():
+    def __init__(self, path):
+        self.path = path
+        self.summaries = dict()
+        self.files = dict()
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    content = json.load(f)
+                if content.get('version') == analysisVersion:
+                    self.summaries = content['summaries']
+                    self.files = content['files']
+            except (OSError, ValueError, KeyError):
+                pass
+
+    """ Known hash of a file, None if it changed (size or mtime) since it was hashed """
+    def getHash(self, path):
+        stat = os.stat(path)
+        entry = self.files.get(os.path.abspath(path))
+        if entry is not None and entry[0] == stat.st_size and entry[1] == stat.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def setHash(self, path, fileHash):
+        stat = os.stat(path)
+        self.files[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns, fileHash]
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(dict(version=analysisVersion, summaries=self.summaries, files=self.files), f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+""" Return the session files of a directory, recursively """
+def findSessions(directory):
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        paths += [os.path.join(root, name) for name in files if name.endswith(('.oxs', '.oxz'))]
+    return sorted(paths)
+
+
+""" Summaries of the sessions of a directory, {path: summary}, analyzed in a pool of jobs processes """
+def analyzeDirectory(directory, jobs=None, useCache=True):
+    cache = AnalysisCache(os.path.join(directory, cacheFileName) if useCache else None)
+    summaries = dict()
+    paths = findSessions(directory)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        # hash the new / modified files, then analyze the ones whose content isn't known
+        hashes = dict((path, cache.getHash(path)) for path in paths)
+        unknown = [path for path in paths if hashes[path] is None]
+        for path, fileHash in zip(unknown, executor.map(hashFile, unknown, chunksize=4)):
+            hashes[path] = fileHash
+            cache.setHash(path, fileHash)
+        pending = []
+        for path in paths:
+            if hashes[path] in cache.summaries:
+                summaries[path] = cache.summaries[hashes[path]]
+            else:
+                pending.append(path)
+        for path, fileHash, summary in executor.map(analyzeFile, pending, [hashes[path] for path in pending], chunksize=4):
+            if summary is not None:
+                summaries[path] = summary
+                cache.summaries[fileHash] = summary
+    if unknown or pending:
+        cache.save()
+    return summaries
+
+
+# columns of the csv summary
+csvColumns = ['startTime', 'duration', 'validDuration', 'minSpO2', 'meanSpO2', 'maxSpO2', 'minPulse', 'meanPulse', 'maxPulse'] + \
+             ['timeBelow{0}'.format(threshold) for threshold in config.analysisSpO2Thresholds] + \
+             ['desaturationCount', 'odi', 'holdCount', 'longestHold', 'contractionCount', 'gapCount', 'missingSamples', 'gapDuration']
+
+
+""" Launcher """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize the recorded sessions of a directory')
+    parser.add_argument('directory', nargs='?', default=config.sessionDir)
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes, one per cpu by default')
+    parser.add_argument('--csv', help='write the summaries to a csv file')
+    parser.add_argument('--json', help='write the summaries to a json file')
+    parser.add_argument('--no-cache', action='store_true', help='analyze every session again')
+    args = parser.parse_args()
+    summaries = analyzeDirectory(args.directory, args.jobs, not args.no_cache)
+    for path, summary in sorted(summaries.items()):
+        print('{0}: {1:.0f}s, SpO2 min {2}%, ODI {3:.1f}, {4} holds (longest {5:.0f}s)'.format(
+            os.path.relpath(path, args.directory), summary['duration'], summary.get('minSpO2', '--'),
+            summary.get('odi', 0.0), summary['holdCount'], summary['longestHold']))
+    if args.csv:
+        with open(args.csv, 'w') as f:
+            f.write(','.join(['path'] + csvColumns) + '\n')
+            for path, summary in sorted(summaries.items()):
+                f.write(','.join([path] + [str(summary.get(column, '')) for column in csvColumns]) + '\n')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summaries, f, indent=2)
+    sys.exit(0)
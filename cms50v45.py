@@ -13,30 +13,27 @@
 
 #!/usr/bin/env python3
 import serial
-import datetime
+import config
+import frames
+import serialio
+import sampleclock
 
 """ Live data point struct """
 class LiveDataPoint():
     def __init__(self, time, data):
-        if [d & 0x80 != 0 for d in data] != [True, False, False, False, False]:
+        if not data[0] & 0x80 or (data[1] | data[2] | data[3] | data[4]) & 0x80:
             raise ValueError("Invalid data packet.")
 
         self.time = time
 
         # 1st byte
-        self.signalStrength = data[0] & 0x0f
-        self.fingerOut = bool(data[0] & 0x10)
-        self.droppingSpO2 = bool(data[0] & 0x20)
-        self.beep = bool(data[0] & 0x40)
+        self.signalStrength, self.fingerOut, self.droppingSpO2, self.beep, statusFlags = frames.statusFields[data[0]]
 
         # 2nd byte
         self.pulseWaveform = data[1]
 
         # 3rd byte
-        self.barGraph = data[2] & 0x0f
-        self.probeError = bool(data[2] & 0x10)
-        self.searching = bool(data[2] & 0x20)
-        self.pulseRate = (data[2] & 0x40) << 1
+        self.barGraph, self.probeError, self.searching, self.pulseRate, graphFlags = frames.graphFields[data[2]]
 
         # 4th byte
         self.pulseRate |= data[3] & 0x7f
@@ -44,6 +41,9 @@ class LiveDataPoint():
         # 5th byte
         self.bloodSpO2 = data[4] & 0x7f
 
+        # session flags byte
+        self.flags = statusFlags | graphFlags
+
     def __str__(self):
         return ", ".join(["Time = {0}", "Signal Strength = {1}", "Finger Out = {2}", "Dropping SpO2 = {3}", "Beep = {4}", "Pulse waveform = {5}", "Bar Graph = {6}", "Probe Error = {7}", "Searching = {8}", "Pulse Rate = {9} bpm", "SpO2 = {10}%"]).format(self.time, self.signalStrength, self.fingerOut, self.droppingSpO2, self.beep, self.pulseWaveform, self.barGraph, self.probeError, self.searching, self.pulseRate, self.bloodSpO2)
 
@@ -62,48 +62,85 @@ class LiveDataPoint():
 
 
 class CMS50DDriver():
-    def __init__(self):
+    # nominal rate of the live data (hz)
+    sampleRate = 60
+    # layout of the frames, see frames.frameLayouts
+    firmware = 0
+    # the device is gone after this long without a byte (s), a read polls the port for its strategy timeout
+    silenceTimeout = 5
+
+    def __init__(self, strategy=None):
         self.port = ''
+        self.strategy = serialio.getReadStrategy(strategy)  # see serialio.readStrategies
         self.conn = None
+        self.tail = b''  # bytes of an incomplete frame
+        self.clock = sampleclock.SampleClock(self.sampleRate)
+        self.rateMeter = sampleclock.RateMeter(self.sampleRate)
+        self.stats = frames.StreamStats(frames.frameLayouts[self.firmware].size)  # kept across reconnections
 
     def isConnected(self):
         return type(self.conn) is serial.Serial and self.conn.isOpen()
 
+    """ Forget the state of the stream: clock, measured rate and incomplete frame """
+    def resetStream(self):
+        self.clock.reset()
+        self.rateMeter.reset()
+        self.tail = b''
+
     def connect(self, port):
+        self.resetStream()
+        self.open(port)
+
+    """ Open the port, the stream state is left as is (see resetStream) """
+    def open(self, port):
         self.port = port
         if self.conn is None:
-            self.conn = serial.Serial(port=self.port, baudrate=19200, parity=serial.PARITY_ODD, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS, timeout=5, xonxoff=1)
+            self.conn = serial.Serial(port=self.port, baudrate=19200, parity=serial.PARITY_ODD, stopbits=serial.STOPBITS_ONE, bytesize=serial.EIGHTBITS, xonxoff=1, **serialio.getPortSettings(self.strategy))
         elif not self.isConnected():
             self.conn.open()
+        if self.isConnected():
+            serialio.configurePort(self.conn, self.strategy)
 
     def disconnect(self):
         if self.isConnected():
             self.conn.close()
 
-    def getByte(self):
-        char = self.conn.read()
-        if len(char) == 0:
-            return None
-        else:
-            return ord(char)
-
-    def getLiveData(self):
+    """ Read the port into buffer, at least one byte, returns their count, 0 once nothing came for silenceTimeout """
+    def readInto(self, buffer):
+        silenceEnd = sampleclock.monotonicNs() + self.silenceTimeout * 1e9
+        while True:
+            count = self.pollInto(buffer)
+            if count > 0 or sampleclock.monotonicNs() >= silenceEnd:
+                return count
+
+    """ Read the port into buffer (see serialio.readInto), at least one byte, returns their count, 0 on the strategy timeout """
+    def pollInto(self, buffer):
+        count = serialio.readInto(self.conn, buffer, self.strategy)
+        self.stats.addRead(count)
+        return count
+
+    """ Decode the frames of bytes read at the monotonic time now (ns), returns the stamped records """
+    def decodeData(self, data, now):
+        byteCount = len(self.tail) + len(data)
+        records, self.tail = frames.decodeFrames(data, self.firmware, self.tail)
+        self.stats.addDecoded(byteCount, len(records), len(self.tail))
+        if len(records):
+            self.rateMeter.update(now, len(records))
+            records['time'] = self.clock.stampBatch(len(records), now)
+            self.stats.addTimes(records['time'], self.clock.period)
+        return records
+
+    """ Yield the live data as batches of session records, decoded from whatever bytes are waiting """
+    def getLiveRecords(self):
         try:
-            packet = [0] * 5
-            idx = 0
+            buffer = bytearray(config.serialBufferSize)
+            view = memoryview(buffer)
             while True:
-                byte = self.getByte()
-                if byte is None:
+                count = self.readInto(buffer)
+                if count == 0:
                     break
-
-                if byte & 0x80:
-                    if idx == 5 and packet[0] & 0x80:
-                        yield LiveDataPoint(datetime.datetime.utcnow(), packet)
-                    packet = [0] * 5
-                    idx = 0
-
-                if idx < 5:
-                    packet[idx] = byte
-                    idx += 1
+                records = self.decodeData(view[:count], sampleclock.monotonicNs())
+                if len(records):
+                    yield records
         except:
             self.disconnect()
@@ -0,0 +1,474 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file codec.py
+#  @brief Compressed columnar session files (.oxz)
+#
+#  Same content as a .oxs session, stored per chunk of sessionChunkSize
+#  samples, column by column, with an encoding suited to each signal:
+#   - time: delta of delta (the period is almost constant, mostly zeros)
+#   - pulse rate, SpO2, signal strength: run-length (value, length) pairs
+#   - waveform, bar graph: delta, a smooth signal gives small deltas
+#   - flags: one bit plane per flag
+#  and the chunk is then compressed (zstd, lz4 or zlib, whichever is
+#  available). Chunks are written as they fill up and decompressed one by
+#  one, the footer holds the chunk directory, the event log and the
+#  (compressed) pyramid levels:
+#   - header: magic, format version, start time (ns), nominal rate, firmware
+#   - chunks: chunk header (magic, sample count, size, first / last time,
+#     compression), then the compressed payload
+#   - footer: tagged blocks (CDIR: chunk directory, EVNT, PYRM, GAPS)
+#   - trailer: sample count, footer offset, end magic
+#  A file without trailer (crashed recording) is read by scanning the chunk
+#  headers, all complete chunks are kept, and the events from the event log
+#  of the recording (see session.EventLog).
+#      py codec.py compress sessions/*.oxs
+#**************************************************************************
+
+#!/usr/bin/env python3
+import os
+import sys
+import zlib
+import struct
+import bisect
+import argparse
+import numpy
+import config
+import pyramid
+import session
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+# file format
+fileMagic = b'OXZN'
+fileEndMagic = b'OXZE'
+fileVersion = 2
+headerStruct = struct.Struct('<4sHqdB5x')
+chunkStruct = struct.Struct('<QQqqqB7x')  # offset, size, first sample, first time, last time, compression
+# header of a chunk, from version 2: magic, sample count, payload size, first time, last time, compression
+chunkMagic = b'OXZC'
+chunkHeaderStruct = struct.Struct('<4sIIqqB3x')
+lengthStruct = struct.Struct('<I')
+# compression of a chunk
+compressionIds = {'zlib': 0, 'lz4': 1, 'zstd': 2}
+# number of decompressed chunks kept by a reader
+chunkCacheSize = 4
+
+
+""" Return True if a compression is usable here """
+def isCompressionAvailable(name):
+    if name == 'zstd':
+        return zstandard is not None
+    if name == 'lz4':
+        return lz4frame is not None
+    return name == 'zlib'
+
+
+""" Return the configured compression, zlib when its module isn't installed """
+def getCompression(name=None):
+    name = name if name is not None else config.sessionCompression
+    return name if isCompressionAvailable(name) else 'zlib'
+
+
+def compress(name, payload):
+    if name == 'zstd':
+        return zstandard.ZstdCompressor(level=9).compress(payload)
+    if name == 'lz4':
+        return lz4frame.compress(payload, compression_level=9)
+    return zlib.compress(payload, 9)
+
+
+def decompress(compressionId, payload):
+    if compressionId == compressionIds['zstd']:
+        if zstandard is None:
+            raise IOError('zstandard is required to read this session')
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if compressionId == compressionIds['lz4']:
+        if lz4frame is None:
+            raise IOError('lz4 is required to read this session')
+        return lz4frame.decompress(payload)
+    return zlib.decompress(payload)
+
+
+""" Run-length encode a uint8 column: run count, values, lengths """
+def encodeRuns(values):
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(values)) + 1)) if len(values) else numpy.zeros(0, numpy.int64)
+    lengths = numpy.diff(numpy.concatenate((starts, [len(values)])))
+    return lengthStruct.pack(len(starts)) + values[starts].astype(numpy.uint8).tobytes() + lengths.astype('<u4').tobytes()
+
+
+def decodeRuns(payload, count):
+    count, = lengthStruct.unpack_from(payload, 0)
+    values = numpy.frombuffer(payload, numpy.uint8, count, lengthStruct.size)
+    lengths = numpy.frombuffer(payload, '<u4', count, lengthStruct.size + count)
+    return numpy.repeat(values, lengths)
+
+
+""" Delta encode a uint8 column (wrapping) """
+def encodeDeltas(values):
+    return numpy.diff(values.astype(numpy.uint8), prepend=numpy.uint8(0)).tobytes()
+
+
+def decodeDeltas(payload, count):
+    return numpy.cumsum(numpy.frombuffer(payload, numpy.uint8), dtype=numpy.uint8)
+
+
+""" Delta of delta encode the int64 time column """
+def encodeTimes(times):
+    times = times.astype(numpy.int64)
+    return numpy.diff(numpy.diff(times, prepend=0), prepend=0).astype('<i8').tobytes()
+
+
+def decodeTimes(payload, count):
+    return numpy.cumsum(numpy.cumsum(numpy.frombuffer(payload, '<i8')))
+
+
+""" One bit plane per flag """
+def encodeFlags(flags):
+    return b''.join(numpy.packbits((flags & flag) != 0).tobytes() for flag in flagBits)
+
+
+def decodeFlags(payload, count):
+    flags = numpy.zeros(count, numpy.uint8)
+    planeSize = (count + 7) // 8
+    # files written before a flag was added have fewer planes
+    for iPlane, flag in enumerate(flagBits[:len(payload) // max(1, planeSize)]):
+        plane = numpy.unpackbits(numpy.frombuffer(payload, numpy.uint8, planeSize, iPlane * planeSize), count=count)
+        flags |= plane * numpy.uint8(flag)
+    return flags
+
+
+# bit planes of the flags column, new flags are appended
+flagBits = [session.flagBeep, session.flagFingerOut, session.flagSearching, session.flagDroppingSpO2, session.flagProbeError, session.flagGap]
+# column encoders / decoders, in chunk order
+columnCodecs = [('time', encodeTimes, decodeTimes), ('pulseRate', encodeRuns, decodeRuns), ('spO2', encodeRuns, decodeRuns),
+                ('pulseWaveform', encodeDeltas, decodeDeltas), ('barGraph', encodeDeltas, decodeDeltas),
+                ('signalStrength', encodeRuns, decodeRuns), ('flags', encodeFlags, decodeFlags)]
+
+
+""" Encode records (structured array of session.getRecordDtype) into a chunk payload """
+def encodeChunk(records):
+    payload = bytearray()
+    for name, encoder, decoder in columnCodecs:
+        column = encoder(numpy.ascontiguousarray(records[name]))
+        payload += lengthStruct.pack(len(column)) + column
+    return bytes(payload)
+
+
+""" Decode a chunk payload of count samples into a structured array, or into the given one """
+def decodeChunk(payload, count, records=None):
+    records = numpy.zeros(count, session.getRecordDtype()) if records is None else records
+    offset = 0
+    for name, encoder, decoder in columnCodecs:
+        length, = lengthStruct.unpack_from(payload, offset)
+        offset += lengthStruct.size
+        records[name] = decoder(payload[offset:offset + length], count)
+        offset += length
+    return records
+
+
+""" Streaming writer of a compressed session file, same interface as session.SessionWriter """
+class CompressedSessionWriter():
+    def __init__(self, path, firmware, nominalRate, startTime, compression=None):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.compression = getCompression(compression)
+        self.file = open(path, 'wb')
+        self.file.write(headerStruct.pack(fileMagic, fileVersion, startTime, nominalRate, firmware))
+        self.pending = []  # record arrays of the next chunk
+        self.pendingCount = 0
+        self.sampleCount = 0
+        self.chunks = []
+        self.eventLog = session.EventLog(path)
+
+    """ Append a record, the chunk is compressed and written once full """
+    def addRecord(self, record):
+        self.addRecords(numpy.array([record], session.getRecordDtype()))
+
+    """ Append a batch of records (structured array, see session.getRecordDtype), split on the chunk boundaries """
+    def addRecords(self, records):
+        start = 0
+        while start < len(records):
+            count = min(len(records) - start, config.sessionChunkSize - self.pendingCount)
+            self.pending.append(records[start:start + count])
+            self.pendingCount += count
+            start += count
+            if self.pendingCount >= config.sessionChunkSize:
+                self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.writeChunk(numpy.concatenate([records.astype(session.getRecordDtype(), copy=False) for records in self.pending]))
+            self.pending = []
+            self.pendingCount = 0
+
+    """ Compress and write records (a structured array) as the next chunk """
+    def writeChunk(self, records):
+        payload = compress(self.compression, encodeChunk(records))
+        firstSample = self.chunks[-1][2] + self.chunks[-1][5] if self.chunks else 0
+        firstTime, lastTime = int(records['time'][0]), int(records['time'][-1])
+        self.file.write(chunkHeaderStruct.pack(chunkMagic, len(records), len(payload), firstTime, lastTime, compressionIds[self.compression]))
+        self.chunks.append((self.file.tell(), len(payload), firstSample, firstTime, lastTime, len(records)))
+        self.file.write(payload)
+        self.file.flush()
+        self.sampleCount += len(records)
+
+    """ Log an event (sample index, time ns, event value) right away, the footer gets all of them on close """
+    def addEvent(self, event):
+        self.eventLog.add(event)
+
+    """ Write the footer blocks and close the file """
+    def close(self, events, pyramids, gaps=()):
+        if self.file is None:
+            return
+        self.flush()
+        footerOffset = self.file.tell()
+        compressionId = compressionIds[self.compression]
+        directory = b''.join(chunkStruct.pack(offset, size, firstSample, firstTime, lastTime, compressionId) for offset, size, firstSample, firstTime, lastTime, count in self.chunks)
+        self.writeBlock(b'CDIR', directory)
+        self.writeBlock(b'EVNT', b''.join(session.eventStruct.pack(*event) for event in events))
+        self.writeBlock(b'PYRM', bytes([compressionId]) + compress(self.compression, session.packPyramids(pyramids)))
+        self.writeBlock(b'GAPS', b''.join(session.gapStruct.pack(*gap) for gap in gaps))
+        self.file.write(session.trailerStruct.pack(self.sampleCount, footerOffset, fileEndMagic))
+        self.file.close()
+        self.file = None
+        self.eventLog.remove()
+
+    def writeBlock(self, tag, payload):
+        self.file.write(session.blockStruct.pack(tag, len(payload)))
+        self.file.write(payload)
+
+
+""" Random access reader of a compressed session file, decompresses the chunks it's asked for """
+class CompressedSessionReader():
+    # load() decompresses the whole session into the same columns as session.SessionReader,
+    # so the views, reports and analysis can read it too.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.chunkCache = OrderedDict()
+        self.records = None
+        try:
+            self.readFooter()
+        except (OSError, struct.error) as e:
+            self.file.close()
+            raise ValueError("Invalid compressed session file: {0} ({1})".format(path, e))
+        except ValueError:
+            self.file.close()
+            raise
+
+    """ Read the header and the footer blocks, scan the chunks of an unterminated file """
+    def readFooter(self):
+        magic, version, self.startTime, self.nominalRate, self.firmware = headerStruct.unpack(self.file.read(headerStruct.size))
+        if magic != fileMagic or version > fileVersion:
+            raise ValueError("Invalid compressed session file: " + self.path)
+        fileSize = os.path.getsize(self.path)
+        endMagic = b''
+        if fileSize >= headerStruct.size + session.trailerStruct.size:
+            self.file.seek(-session.trailerStruct.size, os.SEEK_END)
+            self.sampleCount, footerOffset, endMagic = session.trailerStruct.unpack(self.file.read(session.trailerStruct.size))
+        blocks = dict()
+        if endMagic == fileEndMagic:
+            self.file.seek(footerOffset)
+            footer = self.file.read(fileSize - session.trailerStruct.size - footerOffset)
+            offset = 0
+            while offset + session.blockStruct.size <= len(footer):
+                tag, length = session.blockStruct.unpack_from(footer, offset)
+                offset += session.blockStruct.size
+                blocks[tag] = footer[offset:offset + length]
+                offset += length
+        elif version < 2:
+            raise ValueError("Unterminated compressed session file: " + self.path)
+        if b'CDIR' in blocks:
+            self.chunks = list(chunkStruct.iter_unpack(blocks[b'CDIR']))
+        else:
+            self.scanChunks(fileSize)
+        if endMagic == fileEndMagic:
+            self.events = sorted(session.eventStruct.iter_unpack(blocks.get(b'EVNT', b'')))
+        else:
+            self.events = session.readEventLog(self.path)
+        self.gaps = list(session.gapStruct.iter_unpack(blocks[b'GAPS'])) if b'GAPS' in blocks else None
+        try:
+            self.pyramidPayload = decompress(blocks[b'PYRM'][0], blocks[b'PYRM'][1:]) if blocks.get(b'PYRM') else b''
+        except Exception as e:  # zlib.error, the errors of the optional codecs, unknown compression...
+            raise ValueError("Corrupt pyramids of {0} ({1})".format(self.path, e))
+
+    """ Rebuild the chunk directory from the chunk headers (crashed recording), up to the first incomplete chunk """
+    def scanChunks(self, fileSize):
+        self.chunks = []
+        self.sampleCount = 0
+        offset = headerStruct.size
+        while offset + chunkHeaderStruct.size <= fileSize:
+            self.file.seek(offset)
+            magic, count, size, firstTime, lastTime, compressionId = chunkHeaderStruct.unpack(self.file.read(chunkHeaderStruct.size))
+            offset += chunkHeaderStruct.size
+            if magic != chunkMagic or offset + size > fileSize:
+                break
+            self.chunks.append((offset, size, self.sampleCount, firstTime, lastTime, compressionId))
+            self.sampleCount += count
+            offset += size
+
+    def __len__(self):
+        return self.sampleCount
+
+    """ Decompressed records of a chunk """
+    def getChunk(self, iChunk):
+        if iChunk in self.chunkCache:
+            self.chunkCache.move_to_end(iChunk)
+            return self.chunkCache[iChunk]
+        records = self.readChunk(iChunk)
+        self.chunkCache[iChunk] = records
+        if len(self.chunkCache) > chunkCacheSize:
+            self.chunkCache.popitem(last=False)
+        return records
+
+    """ Decompress the records of a chunk, into the given structured array if any, without caching them """
+    def readChunk(self, iChunk, records=None):
+        offset, size, firstSample, firstTime, lastTime, compressionId = self.chunks[iChunk]
+        self.file.seek(offset)
+        try:
+            return decodeChunk(decompress(compressionId, self.file.read(size)), self.getChunkEnd(iChunk) - firstSample, records)
+        except Exception as e:  # zlib.error, struct.error, the errors of the optional codecs...
+            raise ValueError("Corrupt chunk {0} of {1} ({2})".format(iChunk, self.path, e))
+
+    """ Index of the sample after the last one of a chunk """
+    def getChunkEnd(self, iChunk):
+        return self.chunks[iChunk + 1][2] if iChunk + 1 < len(self.chunks) else self.sampleCount
+
+    """ Return the records within [start, end) as a structured array, only their chunks are decompressed, the
+    chunks lying wholly within the range straight into it (concatenating thousands of chunks doubled the load) """
+    def getRecords(self, start=0, end=None):
+        end = self.sampleCount if end is None else min(end, self.sampleCount)
+        if start >= end:
+            return numpy.zeros(0, session.getRecordDtype())
+        firstSamples = [chunk[2] for chunk in self.chunks]
+        result = numpy.zeros(end - start, session.getRecordDtype())
+        for iChunk in range(bisect.bisect_right(firstSamples, start) - 1, bisect.bisect_left(firstSamples, end)):
+            chunkStart, chunkEnd = firstSamples[iChunk], self.getChunkEnd(iChunk)
+            if start <= chunkStart and chunkEnd <= end and iChunk not in self.chunkCache:
+                self.readChunk(iChunk, result[chunkStart - start:chunkEnd - start])
+            else:
+                records = self.getChunk(iChunk)
+                first, last = max(start, chunkStart), min(end, chunkEnd)
+                result[first - start:last - start] = records[first - chunkStart:last - chunkStart]
+        return result
+
+    """ Return the index of the first sample at or after the given time (ns) """
+    def findSample(self, sampleTime):
+        iChunk = max(0, bisect.bisect_right([chunk[3] for chunk in self.chunks], sampleTime) - 1)
+        if not self.chunks:
+            return 0
+        records = self.getChunk(iChunk)
+        return self.chunks[iChunk][2] + int(numpy.searchsorted(records['time'], sampleTime))
+
+    """ Return the records recorded within the time range [startTime, endTime) (ns) """
+    def sliceTime(self, startTime, endTime):
+        return self.getRecords(self.findSample(startTime), self.findSample(endTime))
+
+    """ Decompress the whole session into columns, returns self """
+    def load(self):
+        self.records = self.getRecords()
+        self.times = self.records['time']
+        self.pulseRates = self.records['pulseRate']
+        self.spO2s = self.records['spO2']
+        self.pulseWaveforms = self.records['pulseWaveform']
+        self.barGraphs = self.records['barGraph']
+        self.signalStrengths = self.records['signalStrength']
+        self.flags = self.records['flags']
+        self.pulseRatePyramid = pyramid.MinMaxPyramid(self.pulseRates)
+        self.spO2Pyramid = pyramid.MinMaxPyramid(self.spO2s)
+        if self.pyramidPayload:
+            session.unpackPyramids(self.pyramidPayload, [self.pulseRatePyramid, self.spO2Pyramid])
+        else:
+            self.pulseRatePyramid.update()
+            self.spO2Pyramid.update()
+        return self
+
+    """ Return the events whose sample index is within [start, end) """
+    def getEvents(self, start=0, end=None):
+        return session.sliceEvents(self.events, start, end)
+
+    """ Gaps of the stream, see session.findGaps, found from the sample times in files recorded without them """
+    def getGaps(self):
+        if self.gaps is None:
+            times = self.times if self.records is not None else self.getRecords()['time']
+            self.gaps = session.findGaps(times, 1e9 / self.nominalRate)
+        return self.gaps
+
+    """ Average sample rate (hz) measured over the session """
+    def getSampleRate(self):
+        if self.sampleCount < 2 or not self.chunks or self.chunks[-1][4] == self.chunks[0][3]:
+            return self.nominalRate
+        return (self.sampleCount - 1) * 1e9 / (self.chunks[-1][4] - self.chunks[0][3])
+
+    def close(self):
+        self.chunkCache.clear()
+        self.file.close()
+
+
+""" Open a session file of any format, compressed ones are decompressed in memory """
+def openSession(path):
+    if path.endswith('.oxz'):
+        return CompressedSessionReader(path).load()
+    return session.SessionReader(path)
+
+
+""" Write a .oxs session file as a compressed .oxz one """
+def compressSession(sourcePath, path, compression=None):
+    reader = session.SessionReader(sourcePath)
+    try:
+        writer = CompressedSessionWriter(path, reader.firmware, reader.nominalRate, reader.startTime, compression)
+        records = reader.records[:].astype(session.getRecordDtype())
+        for start in range(0, len(records), config.sessionChunkSize):
+            writer.writeChunk(records[start:start + config.sessionChunkSize])
+        writer.close(reader.events, [reader.pulseRatePyramid, reader.spO2Pyramid], reader.getGaps())
+    finally:
+        reader.close()
+
+
+""" Write a compressed .oxz session file back as a .oxs one """
+def decompressSession(sourcePath, path):
+    reader = CompressedSessionReader(sourcePath).load()
+    try:
+        writer = session.SessionWriter(path, reader.firmware, reader.nominalRate, reader.startTime)
+        for record in reader.records.tolist():
+            writer.addRecord(record)
+        writer.close(reader.events, [reader.pulseRatePyramid, reader.spO2Pyramid], reader.getGaps())
+    finally:
+        reader.close()
+
+
+""" Launcher """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compress / decompress session files')
+    parser.add_argument('command', choices=('compress', 'decompress'))
+    parser.add_argument('sessions', nargs='+', help='session files (.oxs to compress, .oxz to decompress)')
+    parser.add_argument('--compression', choices=sorted(compressionIds), default=None, help='defaults to config.sessionCompression')
+    parser.add_argument('--delete', action='store_true', help='delete the source files once converted')
+    args = parser.parse_args()
+    for sourcePath in args.sessions:
+        path = os.path.splitext(sourcePath)[0] + ('.oxz' if args.command == 'compress' else '.oxs')
+        if args.command == 'compress':
+            compressSession(sourcePath, path, args.compression)
+        else:
+            decompressSession(sourcePath, path)
+        print('{0} -> {1} ({2:.1%})'.format(sourcePath, path, os.path.getsize(path) / os.path.getsize(sourcePath)))
+        if args.delete:
+            os.remove(sourcePath)
+            # event log of a crashed recording, its events are in the new footer
+            if os.path.exists(session.getEventLogPath(sourcePath)):
+                os.remove(session.getEventLogPath(sourcePath))
+    sys.exit(0)
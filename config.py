@@ -10,6 +10,7 @@
 #**************************************************************************
 
 #!/usr/bin/env python3
+import os
 from Qtpy.Qt import QtGui
 
 # Color of the background of the bpm and pulse images
@@ -42,3 +43,78 @@ widthBpmCurveImage = 700
 heightImages = 300
 # Number of minutes to monitor
 dfltMinutes = 5
+# Record every acquisition into a session file
+recordSession = True
+# Directory of the recorded session files
+sessionDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions')
+# Format of the recorded session files: 'oxs' (raw, memory mapped) or 'oxz' (compressed)
+sessionFormat = 'oxs'
+# Compression of the .oxz session files: 'zstd', 'lz4' or 'zlib' (zlib when the module isn't installed)
+sessionCompression = 'zstd'
+# Number of samples per chunk of a session file (one minute at 60hz)
+sessionChunkSize = 3600
+# Reopen the port of a stalled / failed oximeter and resume the session
+autoReconnect = True
+# No byte, or no frame in the bytes, read for this long is a stall (seconds)
+stallTimeout = 5.0
+# Delay before a reconnection, doubled after every failed attempt up to the max (seconds)
+reconnectMinDelay = 0.5
+reconnectMaxDelay = 30.0
+# How the drivers read their port (see serialio.readStrategies): 'latency' (small reads, low latency mode, for alarms),
+# 'throughput' (large gathered reads, for bulk recording) or 'event' (read whatever is waiting when the port is ready)
+serialReadStrategy = 'event'
+# Size of the preallocated serial read buffers (bytes)
+serialBufferSize = 4096
+# Capacity of the acquisition pipeline queues (batches): raw reads waiting for the decoder, and per sink
+pipelineQueueSize = 256
+sessionQueueSize = 256
+# Capacity of the recorder queue, the disk can stall this long before the decoder waits (~4 minutes at 60hz)
+recorderQueueSize = 16384
+# Publish the samples of the acquired devices on the shared memory sample bus (always on with worker processes)
+sampleBus = False
+# Capacity of the ring of a device on the sample bus (samples)
+sampleBusSize = 8192
+# Number of worker processes acquiring the dashboard devices (0: a thread per device in the ui process)
+acquisitionProcesses = 0
+# Period of the update notifications of the worker processes (seconds)
+workerNotifyPeriod = 0.02
+# Speed of the pulse curve (pixels per second)
+pulsePixelRate = 30
+# Period of the oximeter stream health check (ms)
+healthCheckPeriod = 500
+# Refresh rate of the curve views (frames per second)
+renderFrequency = 30
+# Max fraction of the frame time spent rendering before the frame rate / detail is reduced
+renderBudget = 0.5
+# Lowest refresh rate of the curve views under CPU pressure (frames per second)
+minRenderFrequency = 5
+# Render the curves with OpenGL (QOpenGLWidget)
+useOpenGL = False
+# Use the software OpenGL rasterizer (Mesa llvmpipe), for hosts without GPU
+softwareOpenGL = False
+# Frequency of the axis labels (a label every X)
+axisLabelFrequency = 20
+# Number of tile columns of the dashboard (0: as square as possible)
+dashboardColumns = 0
+# Minimum size of a dashboard tile
+widthTile = 300
+heightTile = 170
+# Duration of the sparkline of a dashboard tile (seconds)
+sparklineSeconds = 120
+# Alarm thresholds of the dashboard tiles
+spO2AlarmThreshold = 90
+pulseLowAlarmThreshold = 40
+pulseHighAlarmThreshold = 140
+# Color of a tile in alarm
+alarmColor = QtGui.QColor(200, 0, 0)
+# Size of the PNG session reports (pixels)
+widthReport = 1600
+heightReport = 900
+# Resolution of the PDF session reports (dpi)
+reportResolution = 150
+# SpO2 thresholds of the session analysis (time spent below each, %)
+analysisSpO2Thresholds = [90, 85, 80]
+# Oxygen desaturation index: drop from the baseline (%), min duration (seconds), baseline window (seconds)
+desaturationDrop = 3
+desaturationMinDuration = 10
+desaturationBaseline = 120
@@ -0,0 +1,238 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file dashboard.py
+#  @brief Wall dashboard monitoring several oximeters
+#
+#  All the tiles are painted by a single widget driven by one render
+#  scheduler: each frame a tile compares what it would show (values, alarm,
+#  sparkline column) with what it shows, and only the changed tiles are
+#  invalidated. Qt merges their rects into one paint pass, which repaints
+#  nothing but those tiles.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import sys
+import math
+import argparse
+import config
+import utils
+import views
+import codec
+import session
+import scheduler
+import sampleclock
+import workers
+from enum import Enum
+from acquisition import DeviceReader, parseDevice
+from Qtpy.Qt import QtCore, QtGui, QtWidgets
+
+
+class AlarmState(Enum):
+    NONE = 0
+    NO_SIGNAL = 1
+    LOW_SPO2 = 2
+    PULSE = 3
+
+
+""" One monitored device: a session source, its last values and alarm state """
+class DeviceTile():
+    def __init__(self, name, source, reader=None):
+        self.name = name
+        self.source = source
+        self.reader = reader  # acquisition thread of a live source
+        self.rect = QtCore.QRect()
+        self.state = None  # what the tile showed at its last invalidation
+
+    """ Samples per sparkline column, for a sparkline width in pixels """
+    def getColumnSpan(self, width):
+        return max(1, int(config.sparklineSeconds * self.source.getSampleRate() / max(1, width)))
+
+    """ Return the sparkline columns [start, end), aligned on columns so they only move once a column is complete """
+    def getSparklineRange(self, width):
+        columnSpan = self.getColumnSpan(width)
+        end = (len(self.source) // columnSpan + 1) * columnSpan
+        return end - width * columnSpan, end
+
+    def getHealth(self):
+        if self.reader is None:
+            return sampleclock.RateHealth.OK
+        return self.reader.getHealth()
+
+    def getAlarm(self):
+        sampleCount = len(self.source)
+        if sampleCount == 0 or self.getHealth() == sampleclock.RateHealth.STALLED:
+            return AlarmState.NO_SIGNAL
+        if self.source.flags[sampleCount - 1] & (session.flagFingerOut | session.flagProbeError):
+            return AlarmState.NO_SIGNAL
+        if self.source.spO2s[sampleCount - 1] < config.spO2AlarmThreshold:
+            return AlarmState.LOW_SPO2
+        if not config.pulseLowAlarmThreshold <= self.source.pulseRates[sampleCount - 1] <= config.pulseHighAlarmThreshold:
+            return AlarmState.PULSE
+        return AlarmState.NONE
+
+    """ Everything the tile shows, compared between frames to skip unchanged tiles (no sparkline for a width of 0) """
+    def getState(self, sparklineWidth):
+        sampleCount = len(self.source)
+        if sampleCount == 0:
+            return (self.getAlarm(),)
+        sparklineColumn = sampleCount // self.getColumnSpan(sparklineWidth) if sparklineWidth > 0 else None
+        return (self.getAlarm(), self.source.pulseRates[sampleCount - 1], self.source.spO2s[sampleCount - 1], sparklineColumn)
+
+
+""" Grid of device tiles painted by a single widget """
+class Dashboard(QtWidgets.QWidget):
+    def __init__(self, parent=None):
+        QtWidgets.QWidget.__init__(self, parent)
+        self.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
+        self.tiles = []
+        self.spacing = 4
+        self.numericOnly = False
+        self.nameFont = QtGui.QFont("Arial", 10, QtGui.QFont.Bold)
+        self.valueFont = QtGui.QFont("Arial", 30, QtGui.QFont.Bold)
+
+    def sizeHint(self):
+        columns, rows = self.getGridSize()
+        return QtCore.QSize(columns * (config.widthTile + self.spacing), rows * (config.heightTile + self.spacing))
+
+    def addTile(self, tile):
+        self.tiles.append(tile)
+        self.layoutTiles()
+
+    def getGridSize(self):
+        count = max(1, len(self.tiles))
+        columns = config.dashboardColumns or math.ceil(math.sqrt(count))
+        return columns, math.ceil(count / columns)
+
+    def layoutTiles(self):
+        columns, rows = self.getGridSize()
+        width = (self.width() - self.spacing) / columns - self.spacing
+        height = (self.height() - self.spacing) / rows - self.spacing
+        for iTile, tile in enumerate(self.tiles):
+            x = self.spacing + (iTile % columns) * (width + self.spacing)
+            y = self.spacing + (iTile // columns) * (height + self.spacing)
+            tile.rect = QtCore.QRect(int(x), int(y), int(width), int(height))
+            tile.state = None
+        self.update()
+
+    def getSparklineRect(self, tile):
+        rect = tile.rect.adjusted(6, 0, -6, -6)
+        rect.setTop(tile.rect.top() + int(tile.rect.height() * 0.55))
+        return rect
+
+    """ Drop the sparklines under CPU pressure, the tiles only show their values and alarm """
+    def setReducedDetail(self, enable):
+        self.numericOnly = enable
+        self.layoutTiles()
+
+    """ Invalidate the tiles whose content changed since the last frame """
+    def refresh(self):
+        for tile in self.tiles:
+            state = tile.getState(0 if self.numericOnly else self.getSparklineRect(tile).width())
+            if state != tile.state:
+                tile.state = state
+                self.update(tile.rect)
+
+    def resizeEvent(self, event):
+        self.layoutTiles()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(event.rect(), config.gridLineColor)
+        for tile in self.tiles:
+            if tile.rect.intersects(event.rect()):
+                self.drawTile(painter, tile)
+        painter.end()
+
+    def drawTile(self, painter, tile):
+        alarm = tile.getAlarm()
+        painter.fillRect(tile.rect, config.dfltBkgColor)
+        if alarm != AlarmState.NONE:
+            painter.setPen(QtGui.QPen(config.alarmColor, 4))
+            painter.drawRect(tile.rect.adjusted(2, 2, -2, -2))
+        # name and alarm
+        textRect = tile.rect.adjusted(8, 6, -8, 0)
+        painter.setFont(self.nameFont)
+        painter.setPen(config.gridColColor)
+        painter.drawText(textRect, QtCore.Qt.AlignLeft | QtCore.Qt.AlignTop, tile.name)
+        if alarm != AlarmState.NONE:
+            painter.setPen(config.alarmColor)
+            painter.drawText(textRect, QtCore.Qt.AlignRight | QtCore.Qt.AlignTop, alarm.name.replace('_', ' '))
+        # values
+        sampleCount = len(tile.source)
+        bpmText, o2Text = '--', '--%'
+        if sampleCount > 0 and alarm != AlarmState.NO_SIGNAL:
+            bpmText = str(tile.source.pulseRates[sampleCount - 1])
+            o2Text = str(tile.source.spO2s[sampleCount - 1]) + '%'
+        valueRect = QtCore.QRect(textRect.left(), textRect.top() + 16, textRect.width(), int(tile.rect.height() * 0.55) - 22)
+        painter.setFont(self.valueFont)
+        painter.setPen(config.o2Color)
+        painter.drawText(valueRect, QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter, o2Text)
+        painter.setPen(config.bmpColor)
+        painter.drawText(valueRect, QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter, bpmText)
+        # sparkline
+        sparklineRect = self.getSparklineRect(tile)
+        if sampleCount > 0 and sparklineRect.width() > 0 and not self.numericOnly:
+            start, end = tile.getSparklineRange(sparklineRect.width())
+            sparklineArea = QtCore.QRectF(sparklineRect)
+            views.drawColumns(painter, tile.source.pulseRatePyramid.getColumns(start, end, sparklineRect.width()), sparklineArea, 127, config.bmpColor, 2)
+            views.drawColumns(painter, tile.source.spO2Pyramid.getColumns(start, end, sparklineRect.width()), sparklineArea, 127, config.o2Color, 2)
+            painter.setRenderHint(QtGui.QPainter.Antialiasing, False)
+
+
+""" Dashboard window, acquires every device in its own thread, or in processCount worker processes """
+class DashboardUI(QtWidgets.QMainWindow):
+    def __init__(self, devices, sessionPaths=(), processCount=config.acquisitionProcesses):
+        QtWidgets.QMainWindow.__init__(self)
+        self.setWindowTitle('OximeterReader Dashboard')
+        self.setWindowIcon(QtGui.QIcon(utils.getIconsDir() + "oxygen.png"))
+        self.dashboard = Dashboard()
+        self.setCentralWidget(self.dashboard)
+        self.readers = []
+        self.sessionReaders = []
+        self.workerPool = None
+        if processCount > 0 and devices:
+            self.workerPool = workers.WorkerPool(devices, processCount)
+            for reader in self.workerPool.readers:
+                self.dashboard.addTile(DeviceTile(reader.deviceName, reader.session, reader))
+        else:
+            for port, version in devices:
+                reader = DeviceReader(port, version)
+                self.readers.append(reader)
+                self.dashboard.addTile(DeviceTile(reader.deviceName, reader.session, reader))
+        for path in sessionPaths:
+            sessionReader = codec.openSession(path)
+            self.sessionReaders.append(sessionReader)
+            self.dashboard.addTile(DeviceTile(path, sessionReader))
+        for reader in self.readers:
+            reader.start()
+        if self.workerPool is not None:
+            self.workerPool.start()
+        self.renderScheduler = scheduler.RenderScheduler(config.renderFrequency, self)
+        self.renderScheduler.addView(self.dashboard)
+
+    def closeEvent(self, event):
+        for reader in self.readers:
+            reader.stop()
+        if self.workerPool is not None:
+            self.workerPool.stop()
+        for sessionReader in self.sessionReaders:
+            sessionReader.close()
+        event.accept()
+
+
+""" Launcher """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Monitor several oximeters on one dashboard')
+    parser.add_argument('devices', nargs='*', type=parseDevice, help='serial ports, optionally suffixed by the firmware version (e.g. COM3:v4.5), v4.6 by default')
+    parser.add_argument('--session', action='append', default=[], help='also show a recorded session file (.oxs / .oxz)')
+    parser.add_argument('--processes', type=int, default=config.acquisitionProcesses, help='acquire the devices in worker processes (0: threads)')
+    args = parser.parse_args()
+    app = QtWidgets.QApplication(sys.argv)
+    mainWin = DashboardUI(args.devices, args.session, args.processes)
+    mainWin.show()
+    sys.exit(app.exec_())
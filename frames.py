@@ -0,0 +1,173 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file frames.py
+#  @brief Lookup table decoding of the CMS50D+ live data frames
+#
+#  Every field of a frame is a function of a single byte, so each byte
+#  position has 256-entry tables built once at import: a live data point
+#  unpacks a status byte in one lookup, and a batch of frames (stored data,
+#  replay) is decoded by NumPy fancy indexing into session records.
+#  decodeFrames() takes raw serial bytes as they come: frames are found by
+#  their sync bit (the high bit, set only on the first byte in v4.5, clear
+#  only on the first byte in v4.6), invalid ones are skipped and the bytes
+#  of an incomplete last frame are returned to complete the first frame
+#  of the next read.
+#  StreamStats accounts per device for what was read, skipped and lost.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import numpy
+import session
+
+
+""" Byte positions of the fields in a frame of a firmware """
+class FrameLayout():
+    def __init__(self, size, syncHigh, waveform, waveformMask, pulseRate, pulseRateHigh, spO2):
+        self.size = size
+        self.syncHigh = syncHigh  # high bit of the first byte, the other bytes of the frame have the opposite one
+        self.status = 0  # signal strength, finger out, dropping SpO2, beep
+        self.graph = 2  # bar graph, probe error, searching, high bit of the pulse rate
+        self.waveform = waveform
+        self.waveformMask = waveformMask
+        self.pulseRate = pulseRate
+        self.pulseRateHigh = pulseRateHigh
+        self.spO2 = spO2
+
+
+# frame layouts, by OximeterVersion value
+frameLayouts = {0: FrameLayout(5, True, waveform=1, waveformMask=0xff, pulseRate=3, pulseRateHigh=True, spO2=4),
+                1: FrameLayout(9, False, waveform=3, waveformMask=0x7f, pulseRate=5, pulseRateHigh=False, spO2=6)}
+
+
+""" Fields of a status byte: (signalStrength, fingerOut, droppingSpO2, beep, session flags) """
+def getStatusFields(byte):
+    flags = ((session.flagFingerOut if byte & 0x10 else 0) | (session.flagDroppingSpO2 if byte & 0x20 else 0) |
+             (session.flagBeep if byte & 0x40 else 0))
+    return byte & 0x0f, bool(byte & 0x10), bool(byte & 0x20), bool(byte & 0x40), flags
+
+
+""" Fields of a bar graph byte: (barGraph, probeError, searching, high bit of the pulse rate, session flags) """
+def getGraphFields(byte):
+    flags = (session.flagProbeError if byte & 0x10 else 0) | (session.flagSearching if byte & 0x20 else 0)
+    return byte & 0x0f, bool(byte & 0x10), bool(byte & 0x20), (byte & 0x40) << 1, flags
+
+
+# per sample tables, indexed by the raw byte
+statusFields = [getStatusFields(byte) for byte in range(256)]
+graphFields = [getGraphFields(byte) for byte in range(256)]
+
+# batch tables, indexed by arrays of raw bytes
+signalStrengthTable = numpy.array([fields[0] for fields in statusFields], dtype=numpy.uint8)
+statusFlagsTable = numpy.array([fields[4] for fields in statusFields], dtype=numpy.uint8)
+barGraphTable = numpy.array([fields[0] for fields in graphFields], dtype=numpy.uint8)
+pulseRateHighTable = numpy.array([fields[3] for fields in graphFields], dtype=numpy.uint8)
+graphFlagsTable = numpy.array([fields[4] for fields in graphFields], dtype=numpy.uint8)
+
+
+""" Decode a (frame count, frame size) uint8 array of aligned frames into session records (time left to 0) """
+def decodeFrameArray(frames, firmware):
+    layout = frameLayouts[firmware]
+    frames = numpy.asarray(frames, dtype=numpy.uint8).reshape(-1, layout.size)
+    records = numpy.zeros(len(frames), dtype=session.getRecordDtype())
+    records['pulseRate'] = frames[:, layout.pulseRate] & 0x7f
+    if layout.pulseRateHigh:
+        records['pulseRate'] |= pulseRateHighTable[frames[:, layout.graph]]
+    records['spO2'] = frames[:, layout.spO2] & 0x7f
+    records['pulseWaveform'] = frames[:, layout.waveform] & layout.waveformMask
+    records['barGraph'] = barGraphTable[frames[:, layout.graph]]
+    records['signalStrength'] = signalStrengthTable[frames[:, layout.status]]
+    records['flags'] = statusFlagsTable[frames[:, layout.status]] | graphFlagsTable[frames[:, layout.graph]]
+    return records
+
+
+""" Find the valid frames of raw bytes, return them as a (frame count, frame size) uint8 array and the unconsumed tail
+    head holds frames found before the bytes (a (count, frame size) array), they come first """
+def splitFrames(buffer, firmware, head=None):
+    layout = frameLayouts[firmware]
+    head = head if head is not None else numpy.empty((0, layout.size), dtype=numpy.uint8)
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    marks = (data >= 0x80) if layout.syncHigh else (data < 0x80)
+    starts = numpy.flatnonzero(marks)
+    if len(starts) == 0:
+        return head, b''
+    # a frame is valid when its first byte is the only sync byte of its span
+    markCounts = numpy.concatenate(([0], numpy.cumsum(marks, dtype=numpy.int64)))
+    complete = starts[starts + layout.size <= len(data)]
+    valid = complete[markCounts[complete + layout.size] - markCounts[complete] == 1]
+    tail = data[starts[-1]:].tobytes() if starts[-1] + layout.size > len(data) else b''
+    frames = numpy.empty((len(head) + len(valid), layout.size), dtype=numpy.uint8)
+    frames[:len(head)] = head
+    numpy.take(data, valid[:, None] + numpy.arange(layout.size), out=frames[len(head):])
+    return frames, tail
+
+
+""" Decode the frames of raw serial bytes into session records (time left to 0), return them and the unconsumed tail
+    tail is the unconsumed tail of the previous bytes: its frame is completed on its own, the bytes aren't copied after it """
+def decodeFrames(buffer, firmware, tail=b''):
+    missing = frameLayouts[firmware].size - len(tail)
+    if tail and len(buffer) < missing:
+        # still within the frame of the tail
+        frames, tail = splitFrames(tail + bytes(buffer), firmware)
+    elif tail:
+        # the frame of the tail stands before any sync byte of the buffer, its own tail is found again in the buffer
+        head = splitFrames(tail + bytes(buffer[:missing]), firmware)[0]
+        frames, tail = splitFrames(buffer, firmware, head)
+    else:
+        frames, tail = splitFrames(buffer, firmware)
+    return decodeFrameArray(frames, firmware), tail
+
+
+""" Per-device accounting of the stream: reads, timeouts, short reads, discarded bytes and lost frames """
+class StreamStats():
+    def __init__(self, frameSize):
+        self.frameSize = frameSize
+        self.reads = 0
+        self.timeouts = 0  # reads that returned nothing within the port timeout
+        self.shortReads = 0  # reads ending within a frame, completed by the next one
+        self.bytes = 0
+        self.discardedBytes = 0  # bytes of corrupt or truncated frames
+        self.frames = 0
+        self.gaps = 0
+        self.missingFrames = 0  # frames lost in the gaps of the sample times
+        self.lastTime = None
+
+    """ Account for a read of count bytes, 0 on timeout """
+    def addRead(self, count):
+        self.reads += 1
+        self.bytes += count
+        if count == 0:
+            self.timeouts += 1
+
+    """ Account for byteCount bytes (the previous tail included) decoded into frameCount frames and a tail """
+    def addDecoded(self, byteCount, frameCount, tailLength):
+        self.frames += frameCount
+        self.discardedBytes += byteCount - frameCount * self.frameSize - tailLength
+        if tailLength:
+            self.shortReads += 1
+
+    """ Account for the gaps of stamped sample times, against the sample period (ns) """
+    def addTimes(self, times, period):
+        if len(times) == 0:
+            return
+        gaps = session.findGaps(times, period, self.lastTime)
+        self.gaps += len(gaps)
+        self.missingFrames += sum(gap[1] for gap in gaps)
+        self.lastTime = int(times[-1])
+
+    """ Frames lost: missing from the sample times or discarded as corrupt """
+    def getLostFrames(self):
+        return self.missingFrames + self.discardedBytes // self.frameSize
+
+    """ Fraction of the frames lost """
+    def getLossRatio(self):
+        lost = self.getLostFrames()
+        return lost / (self.frames + lost) if self.frames + lost else 0.0
+
+    def getMetrics(self):
+        return dict(reads=self.reads, timeouts=self.timeouts, shortReads=self.shortReads, bytes=self.bytes, discardedBytes=self.discardedBytes,
+                    frames=self.frames, gaps=self.gaps, missingFrames=self.missingFrames, lostFrames=self.getLostFrames(), lossRatio=self.getLossRatio())
@@ -0,0 +1,115 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file glviews.py
+#  @brief OpenGL-accelerated curve views
+#
+#  The views paint through QPainter on a QOpenGLWidget: Qt's OpenGL paint
+#  engine batches the lines of a frame into vertex arrays drawn by the GPU
+#  (or by Mesa's software rasterizer, see config.softwareOpenGL). They read
+#  the same session buffers and share the drawing code of the CPU views.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import importlib
+import config
+import views
+from Qtpy import Qt
+from Qtpy.Qt import QtCore, QtGui, QtWidgets
+
+
+""" Return the QOpenGLWidget class of the current binding, None if not available """
+def getOpenGLWidgetClass():
+    try:
+        return getattr(importlib.import_module(Qt.__binding__ + '.QtWidgets'), 'QOpenGLWidget', None)
+    except ImportError:
+        return None
+
+
+QOpenGLWidget = getOpenGLWidgetClass()
+
+
+""" Return True if the OpenGL views can be used """
+def isAvailable():
+    return QOpenGLWidget is not None
+
+
+""" Request the software rasterizer, must be called before the QApplication is created """
+def setupApplication():
+    if config.useOpenGL and config.softwareOpenGL:
+        QtCore.QCoreApplication.setAttribute(QtCore.Qt.AA_UseSoftwareOpenGL)
+
+
+""" Create a history view, OpenGL accelerated if enabled in the config """
+def createHistoryView(size, parent=None):
+    if config.useOpenGL and isAvailable():
+        return GLHistoryView(size, parent)
+    return views.HistoryView(size, parent)
+
+
+""" Create a pulse view, OpenGL accelerated if enabled in the config """
+def createPulseView(size, parent=None):
+    if config.useOpenGL and isAvailable():
+        return GLPulseView(size, parent)
+    return views.PulseView(size, parent)
+
+
+if isAvailable():
+    """ History view painted by the OpenGL paint engine """
+    class GLHistoryView(views.HistoryViewBase, QOpenGLWidget):
+        def __init__(self, size, parent=None):
+            QOpenGLWidget.__init__(self, parent)
+            self.initView(size)
+
+        def paintGL(self):
+            painter = QtGui.QPainter(self)
+            self.render(painter)
+            painter.end()
+
+
+    """ Sweeping pulse waveform painted by the OpenGL paint engine """
+    class GLPulseView(QOpenGLWidget):
+        # The whole visible sweep is redrawn every frame, so there is no offscreen image to keep
+        # in sync and a resize is just the next frame.
+        def __init__(self, size, parent=None):
+            QOpenGLWidget.__init__(self, parent)
+            self.setMinimumSize(size)
+            self.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Expanding)
+            self.source = None
+            self.rateMeter = None
+            self.sourceRate = None
+            self.pulseMaxValue = 100
+            self.sampleCount = 0
+            self.paused = False
+
+        def sizeHint(self):
+            return self.minimumSize()
+
+        def setSource(self, source, rateMeter=None):
+            self.source = source
+            self.rateMeter = rateMeter
+            self.sourceRate = views.Timeline(source).getRate() if source is not None and rateMeter is None else None
+            self.sampleCount = 0
+            self.update()
+
+        def setReducedDetail(self, enable):
+            self.paused = enable
+
+        def refresh(self):
+            if self.source is not None and not self.paused and len(self.source) != self.sampleCount:
+                self.sampleCount = len(self.source)
+                self.update()
+
+        def paintGL(self):
+            painter = QtGui.QPainter(self)
+            painter.fillRect(self.rect(), config.dfltBkgColor)
+            if self.source is not None and self.sampleCount > 0:
+                decimation = views.getPulseDecimation(self.rateMeter.getRate() if self.rateMeter is not None else self.sourceRate)
+                lastPixel = (self.sampleCount - 1) // decimation
+                firstPixel = max(0, lastPixel - self.width() + int(self.width() * 0.2) + 1)
+                views.drawPulsePixels(painter, self.source, decimation, self.width(), self.height(), firstPixel, lastPixel, self.pulseMaxValue)
+            painter.end()
@@ -13,9 +13,11 @@
 import sys
 from Qtpy.Qt import QtWidgets
 import ui
+import glviews
 
 """ Launcher """
 if __name__ == "__main__":
+    glviews.setupApplication()
     app = QtWidgets.QApplication(sys.argv)
     mainWin = ui.ReaderUI()
     mainWin.show()
@@ -5,6 +5,8 @@
 
 import sys, struct, serial, argparse
 import datetime
+import frames
+from acquisition import OximeterVersion
 
 #####################
 ##### Variables #####
@@ -46,18 +48,18 @@ def get_raw_data(ser):
     sys.stdout.write("reading...")
     sys.stdout.flush()
     ser.write(b'\x7d\x81\xa1\x80\x80\x80\x80\x80\x80')
-    raw = list(ser.read(9))
-    while len(raw) >= 9:
-        printer = ''
-        for i in raw:
-            printer += str(i & 0x7f) + " - "
-        print(printer)
-        #print (str(raw[5] & 0x7f) + " - " + str(raw[6] & 0x7f))
-        #print (ord(str(raw[6])) & 0x7f)
-        #print(raw)
-        raw = ser.read(9)
+    # frames are found and masked in batches, a frame split between two reads is kept in tail
+    tail = b''
+    received = 0
+    raw = ser.read(9)
+    while len(raw) > 0:
+        received += len(raw)
+        packets, tail = frames.splitFrames(tail + raw, OximeterVersion.FOURSIX.value)
+        for packet in packets & 0x7f:
+            print(" - ".join(str(i) for i in packet) + " - ")
+        raw = ser.read(max(9, ser.in_waiting))
     ser.close()
-    if len(raw) <= 1:
+    if received <= 1:
         print("no data received. Is the device on?")
         exit(43)
     print("done!")
@@ -0,0 +1,217 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file pipeline.py
+#  @brief Staged acquisition: reader -> decoder -> sinks, over bounded queues
+#
+#  The reader only reads the serial port into preallocated buffers and
+#  queues them with their arrival time, the decoder turns them into stamped
+#  record batches and fans them out to the sinks (in-memory session,
+#  recorder, ...), each in its own thread behind its own bounded queue. The reader queue drops its oldest
+#  reads when full, so a stalled decoder or sink never stops the serial
+#  reads (the device buffer would overflow); each sink chooses whether it
+#  blocks the decoder or drops batches. Queue occupancy and drops are
+#  measured per stage, and so is the latency of the samples from their
+#  stamp to their delivery by each sink.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import config
+import serialio
+import sampleclock
+from enum import Enum
+from collections import deque, OrderedDict
+from threading import Thread, Condition
+
+
+class QueuePolicy(Enum):
+    BLOCK = 0  # wait for room: lossless, the producer waits
+    DROP_NEWEST = 1  # discard the incoming item
+    DROP_OLDEST = 2  # discard the oldest queued item
+
+
+""" Bounded FIFO between two stages, with its overflow policy and occupancy metrics """
+class BoundedQueue():
+    def __init__(self, capacity, policy=QueuePolicy.DROP_OLDEST, onDrop=None):
+        self.capacity = capacity
+        self.policy = policy
+        self.onDrop = onDrop  # called with every dropped item
+        self.items = deque()
+        self.condition = Condition()
+        self.closed = False
+        self.putCount = 0
+        self.dropped = 0
+        self.peak = 0
+        self.occupancySum = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    """ Queue an item, returns False if it was dropped """
+    def put(self, item):
+        with self.condition:
+            if self.policy == QueuePolicy.BLOCK:
+                while len(self.items) >= self.capacity and not self.closed:
+                    self.condition.wait()
+            elif len(self.items) >= self.capacity:
+                self.dropped += 1
+                dropped = item if self.policy == QueuePolicy.DROP_NEWEST else self.items.popleft()
+                if self.onDrop is not None:
+                    self.onDrop(dropped)
+                if self.policy == QueuePolicy.DROP_NEWEST:
+                    return False
+            if self.closed:
+                return False
+            self.items.append(item)
+            self.putCount += 1
+            self.occupancySum += len(self.items)
+            self.peak = max(self.peak, len(self.items))
+            self.condition.notify_all()
+            return True
+
+    """ Wait for the next item, None once the queue is closed and drained """
+    def get(self):
+        with self.condition:
+            while not self.items and not self.closed:
+                self.condition.wait()
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.condition.notify_all()
+            return item
+
+    """ No more items: get returns None once drained, blocked puts give up """
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    """ Occupancy metrics: current length, capacity, peak and mean length at put, dropped items """
+    def getMetrics(self):
+        meanLength = self.occupancySum / self.putCount if self.putCount else 0.0
+        return dict(length=len(self.items), capacity=self.capacity, peak=self.peak, mean=meanLength, dropped=self.dropped)
+
+
+""" Consumer stage of a pipeline: calls consume(records) for every decoded batch, in its own thread """
+class Sink(Thread):
+    def __init__(self, name, consume, capacity, policy=QueuePolicy.DROP_OLDEST):
+        Thread.__init__(self, name=name, daemon=True)
+        self.consume = consume
+        self.queue = BoundedQueue(capacity, policy)
+        self.clock = None  # sample clock of the driver, set by the pipeline
+        self.latency = sampleclock.LatencyMeter()
+        self.error = None  # exception that stopped the sink
+
+    def run(self):
+        try:
+            while True:
+                records = self.queue.get()
+                if records is None:
+                    break
+                self.consume(records)
+                if self.clock is not None:
+                    # the oldest sample of the batch waited the longest
+                    self.latency.add(int(records['time'][0]), self.clock)
+        except Exception as e:
+            self.error = e
+            # the decoder must not block on a sink that stopped consuming
+            self.queue.close()
+
+
+""" Reader -> decoder -> sinks pipeline of a driver (see cms50v45.CMS50DDriver.readInto / decodeData) """
+class Pipeline():
+    def __init__(self, driver, sinks, capacity=config.pipelineQueueSize):
+        self.driver = driver
+        self.sinks = list(sinks)
+        for sink in self.sinks:
+            sink.clock = driver.clock
+        # read buffers: the queued ones, the one being decoded and the one being read
+        self.buffers = serialio.BufferPool(capacity + 2, config.serialBufferSize)
+        self.rawQueue = BoundedQueue(capacity, QueuePolicy.DROP_OLDEST, self.dropRead)
+        self.resetPending = False  # a dropped read started a new stream
+        self.decoder = Thread(target=self.decode, name='decoder', daemon=True)
+        self.error = None  # exception that stopped the reader or the decoder
+
+    """ Overflow of the raw queue: recycle the buffer, a dropped stream reset applies to the next read """
+    def dropRead(self, item):
+        self.buffers.release(item[1])
+        if item[3]:
+            self.resetPending = True
+
+    """ Decoder stage: stamp and decode the raw reads, fan the batches out to the sinks """
+    def decode(self):
+        try:
+            while True:
+                item = self.rawQueue.get()
+                if item is None:
+                    break
+                arrivalTime, buffer, count, reset = item
+                if reset or self.resetPending:
+                    # first read of a new connection (see supervisor.ConnectionSupervisor)
+                    self.resetPending = False
+                    self.driver.resetStream()
+                records = self.driver.decodeData(memoryview(buffer)[:count], arrivalTime)
+                self.buffers.release(buffer)
+                if len(records):
+                    for sink in self.sinks:
+                        sink.queue.put(records)
+        except Exception as e:
+            self.error = e
+            # the reader stops on the error, its queued reads are dropped
+            self.rawQueue.close()
+        finally:
+            for sink in self.sinks:
+                sink.queue.close()
+
+    """ Exception that stopped a stage, None while they all run """
+    def getError(self):
+        if self.error is not None:
+            return self.error
+        for sink in self.sinks:
+            if sink.error is not None:
+                return sink.error
+        return None
+
+    """ Reader stage, in the calling thread until isActive() is False, the port fails or a stage fails, then drain the stages
+        returns the exception that stopped the pipeline, None when it was stopped or the port timed out """
+    def run(self, isActive):
+        self.decoder.start()
+        for sink in self.sinks:
+            sink.start()
+        try:
+            while isActive() and self.getError() is None:
+                buffer = self.buffers.acquire()
+                count = self.driver.readInto(buffer)
+                if count == 0:
+                    self.buffers.release(buffer)
+                    break
+                reset = self.driver.takeStreamReset() if hasattr(self.driver, 'takeStreamReset') else False
+                self.rawQueue.put((sampleclock.monotonicNs(), buffer, count, reset))
+        except Exception as e:
+            self.error = e
+            self.driver.disconnect()
+        finally:
+            self.rawQueue.close()
+            self.decoder.join()
+            for sink in self.sinks:
+                sink.join()
+        return self.getError()
+
+    """ Occupancy metrics of the queues, and the sample latency of the sinks, by stage name """
+    def getMetrics(self):
+        metrics = OrderedDict([('decoder', self.rawQueue.getMetrics())])
+        for sink in self.sinks:
+            metrics[sink.name] = dict(sink.queue.getMetrics(), latency=sink.latency.getMetrics())
+        return metrics
+
+    """ Number of raw reads dropped before the decoder """
+    def getDroppedReads(self):
+        return self.rawQueue.dropped
+
+    """ Number of decoded batches dropped by the sinks """
+    def getDroppedBatches(self):
+        return sum(sink.queue.dropped for sink in self.sinks)
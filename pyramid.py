@@ -0,0 +1,98 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file pyramid.py
+#  @brief Multi-resolution min/max pyramid over a sample column
+#
+#  Level 0 is the sample column itself, level k holds the min and max of
+#  every aligned block of 2^k samples. Levels are built incrementally as
+#  samples arrive (amortized O(1) per sample) and the min/max of any range
+#  is answered from O(log n) blocks, so a view renders in O(pixels) no
+#  matter how many samples each pixel column covers.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import numpy
+from array import array
+
+# above this number of new blocks, a level is built with NumPy (e.g. when loading a whole file)
+vectorizeThreshold = 64
+
+
+class MinMaxPyramid():
+    def __init__(self, values, typecode='B'):
+        self.values = values
+        self.typecode = typecode
+        self.mins = [values]  # level 0 is the sample column itself
+        self.maxs = [values]
+
+    """ Build the blocks completed by the samples appended since the last update """
+    def update(self):
+        level = 1
+        while len(self.mins[level - 1]) >= 2:
+            if level == len(self.mins):
+                self.mins.append(array(self.typecode))
+                self.maxs.append(array(self.typecode))
+            lowerMins, lowerMaxs = self.mins[level - 1], self.maxs[level - 1]
+            mins, maxs = self.mins[level], self.maxs[level]
+            first, last = len(mins), len(lowerMins) // 2
+            if last - first > vectorizeThreshold:
+                lower = numpy.asarray(lowerMins)[2 * first:2 * last]
+                mins.frombytes(numpy.minimum(lower[0::2], lower[1::2]).astype(self.typecode).tobytes())
+                lower = numpy.asarray(lowerMaxs)[2 * first:2 * last]
+                maxs.frombytes(numpy.maximum(lower[0::2], lower[1::2]).astype(self.typecode).tobytes())
+                del lower  # the arrays can't grow while exported
+            else:
+                for iBlock in range(first, last):
+                    mins.append(min(lowerMins[2 * iBlock], lowerMins[2 * iBlock + 1]))
+                    maxs.append(max(lowerMaxs[2 * iBlock], lowerMaxs[2 * iBlock + 1]))
+            level += 1
+
+    """ Add a level built elsewhere (e.g. loaded from a session file) """
+    def setLevel(self, level, mins, maxs):
+        while len(self.mins) <= level:
+            self.mins.append(array(self.typecode))
+            self.maxs.append(array(self.typecode))
+        self.mins[level] = mins
+        self.maxs[level] = maxs
+
+    """ Return (min, max) over the samples [start, end), None if the range is empty """
+    def getMinMax(self, start, end):
+        end = min(end, len(self.values))
+        start = max(start, 0)
+        if start >= end:
+            return None
+        lo = None
+        hi = None
+        topLevel = len(self.mins) - 1
+        while start < end:
+            # use the largest complete block aligned on start that fits in the range
+            level = min(topLevel, (end - start).bit_length() - 1)
+            if start:
+                level = min(level, (start & -start).bit_length() - 1)
+            while level > 0 and (start >> level) >= len(self.mins[level]):
+                level -= 1
+            iBlock = start >> level
+            blockMin, blockMax = self.mins[level][iBlock], self.maxs[level][iBlock]
+            lo = blockMin if lo is None or blockMin < lo else lo
+            hi = blockMax if hi is None or blockMax > hi else hi
+            start += 1 << level
+        return (lo, hi)
+
+    """ Return the (min, max) of count columns evenly splitting [start, end), None for empty columns """
+    def getColumns(self, start, end, count):
+        step = (end - start) / count
+        return self.getColumnsBetween([start + iColumn * step for iColumn in range(count + 1)])
+
+    """ Return the exact (min, max) of the columns [bounds[i], bounds[i + 1]), None for empty columns """
+    def getColumnsBetween(self, bounds):
+        # every column from its own aligned blocks (see getMinMax), the blocks of a coarse level crossing
+        # its edges would smear a spike into the neighbouring columns
+        return [self.getMinMax(int(columnStart), int(columnEnd)) for columnStart, columnEnd in zip(bounds[:-1], bounds[1:])]
+
+    def __len__(self):
+        return len(self.values)
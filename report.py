@@ -0,0 +1,172 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file report.py
+#  @brief Headless PNG / PDF reports of recorded sessions
+#
+#  The trend is drawn by the history view code on a plain QPainter device
+#  (QImage or PDF QPrinter) from the min/max pyramids of the session, so a
+#  report costs O(width) whatever the length of the session. It runs on the
+#  offscreen Qt platform when there is no display:
+#      py report.py sessions/*.oxs --format pdf --output-dir reports
+#**************************************************************************
+
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import datetime
+import argparse
+import config
+import views
+import codec
+import analyze
+from Qtpy.Qt import QtCore, QtGui, QtWidgets, QtPrintSupport
+
+# the Qt application of a headless run
+application = None
+
+
+""" Return the Qt application, created on the offscreen platform if there is none yet """
+def getApplication():
+    global application
+    if QtWidgets.QApplication.instance() is None:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        application = QtWidgets.QApplication([])
+    return QtWidgets.QApplication.instance()
+
+
+""" The history view drawing code on any paint device, showing the whole session """
+class TrendRenderer(views.HistoryViewBase):
+    def __init__(self, source, size, ratio=1.0):
+        self.initState()
+        self.renderSize = size
+        self.ratio = ratio
+        self.source = source
+        self.sampleCount = len(source)
+        self.timeline = views.Timeline(source)
+        self.viewStart = 0
+        self.viewSpan = max(1, self.timeline.getDuration())
+
+    def width(self):
+        return self.renderSize.width()
+
+    def height(self):
+        return self.renderSize.height()
+
+    def devicePixelRatioF(self):
+        return self.ratio
+
+    def update(self):
+        pass
+
+
+""" Format a duration in seconds as [h:]mm:ss """
+def formatDuration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+    return '{0:02d}:{1:02d}'.format(minutes, seconds)
+
+
+""" Draw the report of a session (title, trend, statistics) in rect """
+def drawReport(painter, source, rect, title):
+    statistics = analyze.getSummary(source)
+    margin = int(rect.width() / 40)
+    lineHeight = int(rect.height() / 28)
+    font = QtGui.QFont("Arial")
+    font.setPixelSize(int(lineHeight * 0.7))
+    painter.fillRect(rect, QtCore.Qt.white)
+    painter.setFont(font)
+    painter.setPen(QtCore.Qt.black)
+    # title
+    startTime = datetime.datetime.fromtimestamp(source.startTime / 1e9) if hasattr(source, 'startTime') else None
+    header = title
+    if startTime is not None:
+        header += '  -  ' + startTime.strftime('%Y-%m-%d %H:%M:%S')
+    header += '  -  ' + formatDuration(statistics['duration'])
+    painter.drawText(QtCore.QRect(rect.left() + margin, rect.top() + margin, rect.width() - 2 * margin, lineHeight), QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter, header)
+    # trend
+    trendRect = QtCore.QRect(rect.left() + margin, rect.top() + margin + lineHeight * 2, rect.width() - 2 * margin, int(rect.height() * 0.6))
+    if len(source) > 0:
+        painter.save()
+        painter.setClipRect(trendRect)
+        painter.translate(trendRect.topLeft())
+        TrendRenderer(source, trendRect.size()).render(painter)
+        painter.restore()
+    else:
+        painter.fillRect(trendRect, config.dfltBkgColor)
+    # statistics, two columns
+    lines = ['Samples: {0} ({1:.1f} Hz)'.format(statistics['sampleCount'], statistics['sampleRate'])]
+    if 'minSpO2' in statistics:
+        lines += ['SpO2: min {minSpO2}% / mean {meanSpO2:.1f}% / max {maxSpO2}%'.format(**statistics),
+                  'Pulse: min {minPulse} / mean {meanPulse:.0f} / max {maxPulse} bpm'.format(**statistics),
+                  'Time below {0}% SpO2: {1}'.format(config.spO2AlarmThreshold, formatDuration(statistics['timeBelow{0}'.format(config.spO2AlarmThreshold)]))]
+    lines += ['Holds: {0}, longest {1}'.format(statistics['holdCount'], formatDuration(statistics['longestHold'])),
+              'Contractions: {0}'.format(statistics['contractionCount'])]
+    if 'odi' in statistics:
+        lines += ['Desaturation index: {0:.1f} / h'.format(statistics['odi'])]
+    if statistics['gapCount']:
+        lines += ['Signal lost: {0} gaps, {1}'.format(statistics['gapCount'], formatDuration(statistics['gapDuration']))]
+    columnWidth = int((rect.width() - 2 * margin) / 2)
+    top = trendRect.bottom() + lineHeight
+    rowCount = (len(lines) + 1) // 2
+    for iLine, line in enumerate(lines):
+        x = rect.left() + margin + (iLine // rowCount) * columnWidth
+        y = top + (iLine % rowCount) * lineHeight
+        painter.drawText(QtCore.QRect(x, y, columnWidth, lineHeight), QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter, line)
+
+
+""" Render the report of a session (SessionReader, Session or .oxs / .oxz path) into a .png or .pdf file """
+def renderReport(source, path, size=None, title=None):
+    getApplication()
+    ownSource = isinstance(source, str)
+    if ownSource:
+        title = title if title is not None else os.path.basename(source)
+        source = codec.openSession(source)
+    title = title if title is not None else ''
+    try:
+        if path.lower().endswith('.pdf'):
+            printer = QtPrintSupport.QPrinter(QtPrintSupport.QPrinter.HighResolution)
+            printer.setOutputFormat(QtPrintSupport.QPrinter.PdfFormat)
+            printer.setOutputFileName(path)
+            printer.setOrientation(QtPrintSupport.QPrinter.Landscape)
+            printer.setResolution(config.reportResolution)
+            painter = QtGui.QPainter(printer)
+            drawReport(painter, source, painter.viewport(), title)
+            painter.end()
+        else:
+            size = size if size is not None else QtCore.QSize(config.widthReport, config.heightReport)
+            image = QtGui.QImage(size, QtGui.QImage.Format_RGB32)
+            painter = QtGui.QPainter(image)
+            drawReport(painter, source, image.rect(), title)
+            painter.end()
+            if not image.save(path):
+                raise IOError('Unable to write ' + path)
+    finally:
+        if ownSource:
+            source.close()
+
+
+""" Launcher """
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render PNG / PDF reports of recorded sessions')
+    parser.add_argument('sessions', nargs='+', help='session files (.oxs / .oxz)')
+    parser.add_argument('--format', choices=('png', 'pdf'), default='png')
+    parser.add_argument('--output-dir', help='directory of the reports, next to the sessions by default')
+    parser.add_argument('--width', type=int, default=config.widthReport, help='width of the PNG reports')
+    parser.add_argument('--height', type=int, default=config.heightReport, help='height of the PNG reports')
+    args = parser.parse_args()
+    getApplication()
+    for sessionPath in args.sessions:
+        outputDir = args.output_dir if args.output_dir else os.path.dirname(sessionPath)
+        outputPath = os.path.join(outputDir, os.path.splitext(os.path.basename(sessionPath))[0] + '.' + args.format)
+        start = time.perf_counter()
+        renderReport(sessionPath, outputPath, QtCore.QSize(args.width, args.height))
+        print('{0} -> {1} ({2:.2f}s)'.format(sessionPath, outputPath, time.perf_counter() - start))
+    sys.exit(0)
@@ -0,0 +1,257 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file samplebus.py
+#  @brief Shared memory sample bus: a ring of session records per device
+#
+#  Only one process can open the serial port of a device: the acquiring
+#  process publishes its samples in a shared memory ring named after the
+#  device, and any number of local processes (viewers, recorders, analysis
+#  scripts) attach it read-only and poll the new samples, without any copy
+#  through a socket or pickling.
+#  The header is a seqlock: the writer makes the generation odd, writes the
+#  records and the write index, then makes it even again. A reader retries
+#  a header read that overlaps a write, and drops the records that were
+#  overwritten while it copied them.
+#      reader = samplebus.BusReader('COM3')
+#      records = reader.poll()  # structured array, see session.getRecordDtype
+#**************************************************************************
+
+#!/usr/bin/env python3
+import os
+import re
+import mmap
+import time
+import struct
+import numpy
+from multiprocessing import shared_memory
+import config
+import session
+import pipeline
+
+# prefix of the shared memory blocks of the bus
+busPrefix = 'oximeter_'
+# directory of the POSIX shared memory blocks, where they can be listed and mapped read-only
+shmDir = '/dev/shm'
+busMagic = b'OXRB'
+busVersion = 2
+# header: magic, version, record size, capacity, generation (odd while written), pid of the owner ...
+prefixStruct = struct.Struct('<4sHHqQq')
+generationStruct = struct.Struct('<Q')
+generationOffset = 16
+# ... then write index, rate meter interval (ns), last arrival (monotonic ns), active
+stateStruct = struct.Struct('<qdqB7x')
+headerSize = prefixStruct.size + stateStruct.size
+
+
+""" Name of the bus block of a device """
+def getBusName(deviceName):
+    return busPrefix + re.sub(r'[^A-Za-z0-9]+', '', os.path.basename(deviceName))
+
+
+""" Names of the bus blocks currently published on this host (POSIX only) """
+def listBuses():
+    if not os.path.isdir(shmDir):
+        return []
+    return sorted(name for name in os.listdir(shmDir) if name.startswith(busPrefix))
+
+
+""" Ring of records of one device, read side """
+class SampleRingBase():
+    def mapRecords(self, buffer):
+        self.buffer = buffer
+        magic, version, recordSize, self.capacity, generation, self.ownerPid = prefixStruct.unpack_from(buffer, 0)
+        if magic != busMagic or version > busVersion:
+            raise ValueError('Invalid sample bus block')
+        self.records = numpy.ndarray(self.capacity, session.getRecordDtype(recordSize), buffer, headerSize)
+
+    """ Consistent (write index, interval, last arrival, active) of the header, retried while it's being written """
+    def getState(self):
+        while True:
+            generation = generationStruct.unpack_from(self.buffer, generationOffset)[0]
+            if generation % 2 == 0:
+                state = stateStruct.unpack_from(self.buffer, prefixStruct.size)
+                if generationStruct.unpack_from(self.buffer, generationOffset)[0] == generation:
+                    return state
+            time.sleep(0)
+
+    """ Copy the records written since readCount, returns them, the new read count and the number of records lost """
+    def read(self, readCount):
+        writeCount = self.getState()[0]
+        lost = max(0, writeCount - self.capacity - readCount)
+        readCount += lost
+        records = self.records[numpy.arange(readCount, writeCount) % self.capacity]
+        # records overwritten while they were copied
+        overwritten = min(len(records), max(0, self.getState()[0] - self.capacity - readCount))
+        return records[overwritten:], writeCount, lost + overwritten
+
+    def isActive(self):
+        return self.getState()[3] != 0
+
+
+""" Ring of records of one device, write side: created by the acquiring process, or attached by its workers """
+class SampleRing(SampleRingBase):
+    def __init__(self, deviceName, capacity=None):
+        self.name = getBusName(deviceName)
+        self.owner = capacity is not None
+        if self.owner:
+            size = headerSize + capacity * session.recordStruct.size
+            try:
+                self.memory = shared_memory.SharedMemory(self.name, create=True, size=size)
+            except FileExistsError:
+                # left over by an acquisition that didn't exit cleanly, unless its owner still runs
+                ownerPid = getOwnerPid(self.name)
+                if ownerPid is not None and isProcessRunning(ownerPid):
+                    raise FileExistsError('Sample bus block {0} is published by the running process {1}'.format(self.name, ownerPid))
+                stale = shared_memory.SharedMemory(self.name)
+                stale.close()
+                stale.unlink()
+                self.memory = shared_memory.SharedMemory(self.name, create=True, size=size)
+            prefixStruct.pack_into(self.memory.buf, 0, busMagic, busVersion, session.recordStruct.size, capacity, 0, os.getpid())
+            stateStruct.pack_into(self.memory.buf, prefixStruct.size, 0, 0.0, 0, 1)
+        else:
+            # a worker shares the resource tracker of the process that created the block
+            self.memory = shared_memory.SharedMemory(self.name)
+        self.mapRecords(self.memory.buf)
+        self.generation = generationStruct.unpack_from(self.buffer, generationOffset)[0]
+        self.writeCount = self.getState()[0]
+
+    def setGeneration(self, generation):
+        self.generation = generation
+        generationStruct.pack_into(self.buffer, generationOffset, generation)
+
+    """ Append a batch of records and the state of the rate meter of the device """
+    def write(self, records, rateMeter):
+        count = len(records)
+        if count > self.capacity:
+            records = records[-self.capacity:]
+        start = (self.writeCount + count - len(records)) % self.capacity
+        first = min(len(records), self.capacity - start)
+        self.setGeneration(self.generation + 1)
+        self.records[start:start + first] = records[:first]
+        self.records[:len(records) - first] = records[first:]
+        self.writeCount += count
+        lastArrival = rateMeter.lastArrival if rateMeter.lastArrival is not None else 0
+        stateStruct.pack_into(self.buffer, prefixStruct.size, self.writeCount, rateMeter.interval, lastArrival, 1)
+        self.setGeneration(self.generation + 1)
+
+    def setActive(self, active):
+        self.setGeneration(self.generation + 1)
+        writeCount, interval, lastArrival, wasActive = stateStruct.unpack_from(self.buffer, prefixStruct.size)
+        stateStruct.pack_into(self.buffer, prefixStruct.size, writeCount, interval, lastArrival, 1 if active else 0)
+        self.setGeneration(self.generation + 1)
+
+    """ Close the block, the owner marks it inactive for its readers and removes it from the bus """
+    def close(self):
+        if self.owner:
+            self.setActive(False)
+        self.records = None
+        self.buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+""" Pipeline sink publishing the batches of a driver on the bus, returns it and the ring it writes """
+def createSink(deviceName, driver):
+    ring = SampleRing(deviceName, config.sampleBusSize)
+    sink = pipeline.Sink('bus', lambda records: ring.write(records, driver.rateMeter), config.sessionQueueSize, pipeline.QueuePolicy.DROP_OLDEST)
+    return sink, ring
+
+
+""" Read-only client of the ring of a device, polls the samples published since its last poll """
+class BusReader(SampleRingBase):
+    def __init__(self, deviceName, history=False):
+        self.name = deviceName if deviceName.startswith(busPrefix) else getBusName(deviceName)
+        self.memory = None
+        self.map = None
+        path = os.path.join(shmDir, self.name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapRecords(self.map)
+        else:
+            self.memory = attachMemory(self.name)
+            self.mapRecords(self.memory.buf)
+        writeCount = self.getState()[0]
+        self.readCount = max(0, writeCount - self.capacity) if history else writeCount
+        self.lost = 0  # samples overwritten before they were polled
+
+    """ Return the records published since the last poll (structured array, see session.getRecordDtype) """
+    def poll(self):
+        records, self.readCount, lost = self.read(self.readCount)
+        self.lost += lost
+        return records
+
+    def close(self):
+        self.records = None
+        self.buffer = None
+        if self.map is not None:
+            self.map.close()
+        if self.memory is not None:
+            self.memory.close()
+
+
+""" Attach a block created by an unrelated process, which owns (unlinks) it """
+def attachMemory(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        memory = shared_memory.SharedMemory(name)
+        if os.name == 'posix':
+            # before Python 3.13 attaching registers the block to our resource tracker, which would unlink it at exit
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+""" Pid of the process owning a bus block, None if the block has no valid header (older bus version) """
+def getOwnerPid(name):
+    memory = attachMemory(name)
+    try:
+        magic, version, recordSize, capacity, generation, ownerPid = prefixStruct.unpack_from(memory.buf, 0)
+    except struct.error:
+        return None
+    finally:
+        memory.close()
+    return ownerPid if magic == busMagic and version == busVersion else None
+
+
+""" True if a process runs with this pid (on Windows a block only exists while a process maps it) """
+def isProcessRunning(pid):
+    if os.name == 'nt':
+        return True
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # runs as another user
+    return True
+
+
+""" Launcher: list the published devices, or follow one """
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='List the devices published on the sample bus, or print the samples of one')
+    parser.add_argument('device', nargs='?', help='device (serial port) or bus name to follow')
+    args = parser.parse_args()
+    if args.device is None:
+        for name in listBuses():
+            print(name)
+    else:
+        reader = BusReader(args.device)
+        try:
+            while reader.isActive():
+                for record in reader.poll():
+                    print('{0}: pulse {1} bpm, SpO2 {2}%'.format(record['time'], record['pulseRate'], record['spO2']))
+                time.sleep(config.workerNotifyPeriod)
+        except KeyboardInterrupt:
+            pass
+        reader.close()
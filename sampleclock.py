@@ -0,0 +1,254 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file sampleclock.py
+#  @brief Monotonic, drift-corrected sample clock and measured sample rate
+#
+#  Samples are stamped from a monotonic anchor plus the device period, so a
+#  burst of buffered packets gets evenly spaced stamps instead of its read
+#  time. Transport delays are only ever positive, so both the phase and the
+#  period follow the lower envelope of the arrival times: the phase snaps on
+#  early packets and the period is the slope between the earliest packets of
+#  consecutive windows. The slots of lost samples are skipped, so a gap in
+#  the stream is a gap in the stamps. The monotonic to wall offset is slewed
+#  (never stepped) to follow NTP adjustments. Timestamps are integer
+#  nanoseconds since epoch.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import time
+import numpy
+from enum import Enum
+from collections import deque
+
+# number of samples of the period estimation window (10 seconds at 60hz)
+periodWindow = 600
+# smoothing of the period estimate between two windows
+periodGain = 0.2
+# fraction of the arrival delay slowly absorbed in the phase, lets the clock follow a late drift
+phaseLeak = 0.001
+# the period can't drift more than this ratio from the nominal one
+maxPeriodDrift = 0.1
+# no packet for this long (ns) is a stall and re-bases the clock
+rebaseThreshold = 500000000
+# a sample arriving this many periods after the previous one means the samples between them were lost
+gapThreshold = 2.5
+# smoothing of the measured inter-arrival time
+rateGain = 0.01
+# no packet for this long (ns) reports the stream as stalled
+stallTimeout = 1000000000
+# relative difference to the nominal rate before the stream is reported as flooding / slow
+rateTolerance = 0.1
+# number of batches the latency statistics are computed over
+latencyWindow = 1000
+# re-measure the wall clock offset every X seconds
+wallResyncPeriod = 1.0
+# max correction of the wall clock offset, in ns per second of monotonic time (500 ppm)
+maxWallSlew = 500000
+# fraction of the arrival delay absorbed in the phase after X samples (the batches are stamped in runs of a period window at most)
+absorbedDelays = 1 - (1 - phaseLeak) ** numpy.arange(periodWindow + 1)
+# runs of fewer samples are stamped in Python, the NumPy calls cost more than their arithmetic
+minVectorRun = 8
+
+
+""" Current monotonic time in ns """
+def monotonicNs():
+    return int(time.monotonic() * 1e9)
+
+
+""" Current wall time in ns since epoch """
+def wallNs():
+    return int(time.time() * 1e9)
+
+
+class SampleClock():
+    def __init__(self, nominalRate):
+        self.nominalPeriod = 1e9 / nominalRate
+        self.reset()
+
+    """ Restart the clock, the next sample defines the new base """
+    def reset(self):
+        self.period = self.nominalPeriod
+        self.wallOffset = wallNs() - monotonicNs()
+        self.lastResync = monotonicNs()
+        self.sampleCount = 0
+        self.skippedCount = 0  # slots of lost samples
+        self.lastArrival = None
+        self.rebase(None)
+
+    """ Restart the phase and period tracking (after a stall) from the given arrival time """
+    def rebase(self, now):
+        self.anchorTime = now
+        self.anchorIndex = self.sampleCount
+        self.windowMin = None  # (residual, index) of the earliest packet of the current window
+        self.previousMin = None
+        self.windowStart = self.sampleCount
+
+    """ Track the earliest packets per window and derive the period from their slope
+        count samples arrive from now on, spread by the period, only the first one may close the window """
+    def updatePeriod(self, now, count=1):
+        # only the received samples, a wrongly inferred loss must not bend the period
+        received = self.sampleCount - self.skippedCount
+        residual = now - received * self.nominalPeriod
+        if self.windowMin is None or residual < self.windowMin[0]:
+            self.windowMin = (residual, received)
+        if self.sampleCount - self.windowStart >= periodWindow:
+            if self.previousMin is not None and self.windowMin[1] != self.previousMin[1]:
+                slope = (self.windowMin[0] - self.previousMin[0]) / (self.windowMin[1] - self.previousMin[1])
+                period = self.period + periodGain * (self.nominalPeriod + slope - self.period)
+                # the new period only applies from the next sample, the stamps stay continuous
+                self.anchorTime = self.expected()
+                self.anchorIndex = self.sampleCount
+                self.period = max(self.nominalPeriod * (1 - maxPeriodDrift), min(period, self.nominalPeriod * (1 + maxPeriodDrift)))
+            self.previousMin = self.windowMin
+            self.windowMin = None
+            self.windowStart = self.sampleCount
+        if count > 1:
+            # the residuals of the next samples are linear, the earliest one is the second or the last
+            step = self.period - self.nominalPeriod
+            earliest = min((residual + step, received + 1), (residual + (count - 1) * step, received + count - 1))
+            if self.windowMin is None or earliest[0] < self.windowMin[0]:
+                self.windowMin = earliest
+
+    """ Slew the monotonic to wall offset toward the current wall clock """
+    def resyncWall(self, now):
+        elapsed = now - self.lastResync
+        if elapsed < wallResyncPeriod * 1e9:
+            return
+        maxStep = maxWallSlew * elapsed / 1e9
+        error = (wallNs() - now) - self.wallOffset
+        self.wallOffset += int(max(-maxStep, min(error, maxStep)))
+        self.lastResync = now
+
+    """ Return the timestamp (ns since epoch) of a sample read now """
+    def stamp(self, now=None):
+        return int(self.stampBatch(1, now)[0])
+
+    """ Return the timestamps (NumPy array) of count samples read together now, their arrivals spread back by the period """
+    def stampBatch(self, count, now=None):
+        now = monotonicNs() if now is None else now
+        self.resyncWall(now)
+        first = int(now - (count - 1) * self.period)
+        if self.lastArrival is not None and first - self.lastArrival > gapThreshold * self.period:
+            # skip the slots of the lost samples, their stamps show the gap
+            skipped = int(round((first - self.lastArrival) / self.period)) - 1
+            self.sampleCount += skipped
+            self.skippedCount += skipped
+        if self.lastArrival is None or first - self.lastArrival > rebaseThreshold:
+            self.rebase(first)
+        self.lastArrival = now
+        if count <= self.windowStart + periodWindow - self.sampleCount:
+            return self.stampRun(first, count)
+        runs = []
+        start = 0
+        while start < count:
+            # a run stops before the sample closing a period window, the arrivals after it are spread by the new period
+            untilClose = self.windowStart + periodWindow - self.sampleCount
+            run = min(count - start, untilClose) if untilClose > 0 else 1
+            runs.append(self.stampRun(int(now - (count - 1 - start) * self.period), run))
+            start += run
+        return runs[0] if len(runs) == 1 else numpy.concatenate(runs)
+
+    """ Stamp count samples arriving from now on, spread by the period, within a period window """
+    def stampRun(self, now, count):
+        self.updatePeriod(now, count)
+        predicted = self.expected()
+        # arrivals and predictions advance by the same period, the delay of the first one holds for the run
+        delay = now - predicted
+        if delay < 0:
+            # an early packet is the best phase estimate we can get
+            self.anchorTime = now
+            self.anchorIndex = self.sampleCount
+            predicted = now
+            delay = 0
+        # the phase leak of every sample, compounded
+        self.anchorTime += delay * float(absorbedDelays[count])
+        self.sampleCount += count
+        if count < minVectorRun:
+            return numpy.array([int(predicted + i * self.period + delay * (1 - (1 - phaseLeak) ** i)) + self.wallOffset for i in range(count)], numpy.int64)
+        stamps = numpy.arange(count) * self.period
+        stamps += predicted
+        if delay > 0:
+            stamps += delay * absorbedDelays[:count]
+        stamps = stamps.astype(numpy.int64)
+        stamps += self.wallOffset
+        return stamps
+
+    """ Expected monotonic time of the next sample """
+    def expected(self):
+        return self.anchorTime + (self.sampleCount - self.anchorIndex) * self.period
+
+    """ Estimated sample rate (hz) """
+    def getRate(self):
+        return 1e9 / self.period
+
+
+class RateHealth(Enum):
+    OK = 0
+    STALLED = 1
+    FLOODING = 2
+    SLOW = 3
+
+
+""" Online measure of the actual sample rate (EWMA over the inter-arrival times) """
+class RateMeter():
+    def __init__(self, nominalRate):
+        self.nominalRate = nominalRate
+        self.reset()
+
+    def reset(self):
+        self.interval = 1e9 / self.nominalRate
+        self.lastArrival = None
+
+    """ Account for count samples received now """
+    def update(self, now=None, count=1):
+        now = monotonicNs() if now is None else now
+        if self.lastArrival is not None and now - self.lastArrival < stallTimeout:
+            # count EWMA steps of the mean interval at once
+            gain = 1 - (1 - rateGain) ** count
+            self.interval += gain * ((now - self.lastArrival) / count - self.interval)
+        self.lastArrival = now
+
+    """ Measured sample rate (hz) """
+    def getRate(self):
+        return 1e9 / self.interval
+
+    """ Health of the stream: stalled when nothing came for a while, flooding / slow when off its nominal rate """
+    def getHealth(self, now=None):
+        now = monotonicNs() if now is None else now
+        if self.lastArrival is None or now - self.lastArrival > stallTimeout:
+            return RateHealth.STALLED
+        rate = self.getRate()
+        if rate > self.nominalRate * (1 + rateTolerance):
+            return RateHealth.FLOODING
+        if rate < self.nominalRate * (1 - rateTolerance):
+            return RateHealth.SLOW
+        return RateHealth.OK
+
+
+""" End-to-end latency of the samples over the last latencyWindow batches: from their stamp, the earliest arrival the clock
+    has seen (a constant transport delay doesn't show), to their delivery """
+class LatencyMeter():
+    def __init__(self):
+        self.latencies = deque(maxlen=latencyWindow)
+        self.peak = 0
+
+    """ Account for a sample stamped at sampleTime (ns since epoch, see SampleClock) delivered now """
+    def add(self, sampleTime, clock, now=None):
+        now = monotonicNs() if now is None else now
+        latency = now - (sampleTime - clock.wallOffset)
+        self.latencies.append(latency)
+        self.peak = max(self.peak, latency)
+
+    """ Mean, median, 99th percentile and peak latencies (ms) """
+    def getMetrics(self):
+        if not self.latencies:
+            return dict(mean=0.0, median=0.0, p99=0.0, peak=0.0)
+        latencies = sorted(self.latencies)
+        return dict(mean=sum(latencies) / len(latencies) / 1e6, median=latencies[len(latencies) // 2] / 1e6,
+                    p99=latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] / 1e6, peak=self.peak / 1e6)
+
@@ -0,0 +1,116 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file scheduler.py
+#  @brief Single render clock shared by all the views of a window
+#
+#  Every frame the scheduler asks each registered view to refresh(): a view
+#  pulls the new samples of its source and calls update() only if something
+#  it shows changed. Qt merges the update() requests of a frame into one
+#  paint pass per window, so N views cost one timer and one repaint per
+#  frame, and idle views cost nothing but their refresh() check.
+#
+#  The scheduler measures its own load (refresh + paint time over the frame
+#  period) and degrades step by step when it exceeds config.renderBudget:
+#  halving the frame rate down to config.minRenderFrequency, then asking
+#  the views for reduced detail (paused waveforms, numeric only tiles). It
+#  recovers the same way once the load is low again. Hidden and minimized
+#  views are skipped. Acquisition never waits on any of this: views only
+#  read the sessions recorded by the acquisition threads.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import time
+import config
+from Qtpy.Qt import QtCore
+
+# the load must be below renderBudget * recoverRatio before the quality goes back up
+recoverRatio = 0.25
+# the load is measured over windows of X seconds, the quality changes at most once per window
+loadWindow = 2.0
+
+
+class RenderScheduler(QtCore.QObject):
+    def __init__(self, frequency, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.views = []
+        self.maxFrequency = frequency
+        self.reducedDetail = False
+        self.load = 0.0  # fraction of the time spent rendering over the last window
+        self.paintTime = 0.0  # time spent painting the views since the last frame
+        self.busyTime = 0.0  # time spent rendering in the current window
+        self.windowStart = time.perf_counter()
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self.renderFrame)
+        self.setFrequency(frequency)
+
+    """ Change the frame rate (frames per second) """
+    def setFrequency(self, frequency):
+        self.frequency = frequency
+        self.timer.start(int(1000 / frequency))
+
+    """ Register a view, anything with a refresh() method (and optionally setReducedDetail(enable)) """
+    def addView(self, view):
+        if view not in self.views:
+            self.views.append(view)
+            if isinstance(view, QtCore.QObject):
+                view.installEventFilter(self)
+
+    def removeView(self, view):
+        if view in self.views:
+            self.views.remove(view)
+            if isinstance(view, QtCore.QObject):
+                view.removeEventFilter(self)
+
+    """ Time the paint events of the views """
+    def eventFilter(self, watched, event):
+        if event.type() != QtCore.QEvent.Paint:
+            return False
+        start = time.perf_counter()
+        watched.event(event)
+        self.paintTime += time.perf_counter() - start
+        return True
+
+    """ Return False for views nobody can see (hidden, minimized, clipped out) """
+    def isShown(self, view):
+        if not hasattr(view, 'isVisible'):
+            return True
+        return view.isVisible() and not view.window().isMinimized() and not view.visibleRegion().isEmpty()
+
+    """ Let every shown view pull its new data, the changed ones schedule their repaint """
+    def renderFrame(self):
+        start = time.perf_counter()
+        for view in self.views:
+            if self.isShown(view):
+                view.refresh()
+        now = time.perf_counter()
+        self.busyTime += now - start + self.paintTime
+        self.paintTime = 0.0
+        if now - self.windowStart >= loadWindow:
+            self.load = self.busyTime / (now - self.windowStart)
+            self.busyTime = 0.0
+            self.windowStart = now
+            self.adaptQuality()
+
+    """ Step the quality down when over budget, back up when well under it """
+    def adaptQuality(self):
+        if self.load > config.renderBudget:
+            if self.frequency > config.minRenderFrequency:
+                self.setFrequency(max(config.minRenderFrequency, self.frequency / 2))
+            elif not self.reducedDetail:
+                self.setReducedDetail(True)
+        elif self.load < config.renderBudget * recoverRatio:
+            if self.reducedDetail:
+                self.setReducedDetail(False)
+            elif self.frequency < self.maxFrequency:
+                self.setFrequency(min(self.maxFrequency, self.frequency * 2))
+
+    def setReducedDetail(self, enable):
+        self.reducedDetail = enable
+        for view in self.views:
+            if hasattr(view, 'setReducedDetail'):
+                view.setReducedDetail(enable)
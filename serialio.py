@@ -0,0 +1,140 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file serialio.py
+#  @brief Serial reads into preallocated buffers
+#
+#  pyserial's read() (and its readinto(), built on it) allocates a bytearray
+#  and a bytes object per call. On POSIX ports the bytes are read with
+#  os.readv straight into a preallocated buffer, after the same select()
+#  pyserial does for its timeout. Other ports fall back on readinto().
+#  How a driver reads is its ReadStrategy (see readStrategies), its timeout
+#  only bounds a poll of the port: the driver decides when the device is
+#  gone (see cms50v45.CMS50DDriver.silenceTimeout).
+#   - latency: small reads, a short poll and the low latency mode of
+#     USB serial adapters (no 16 ms latency timer), for alarms
+#   - throughput: large reads, gathered until the bytes stop coming for the
+#     inter-byte timeout, fewer wake ups for bulk recording rigs
+#   - event: wait for the port with select() and read whatever is waiting
+#**************************************************************************
+
+#!/usr/bin/env python3
+import os
+import errno
+import select
+import serial
+from collections import deque
+import config
+
+# errors of a non blocking read that only mean "try again"
+retryErrors = (errno.EAGAIN, errno.EALREADY, errno.EWOULDBLOCK, errno.EINPROGRESS, errno.EINTR)
+
+
+""" How a driver reads its port """
+class ReadStrategy():
+    def __init__(self, timeout, readSize=None, interByteTimeout=None, lowLatency=False):
+        self.timeout = timeout  # port timeout (s): a poll returns nothing after it, the driver decides when the device is gone
+        self.readSize = readSize  # max bytes per read, None for the whole buffer
+        self.interByteTimeout = interByteTimeout  # keep reading until readSize bytes or a silence this long (s)
+        self.lowLatency = lowLatency  # ask the serial driver for its low latency mode
+
+
+readStrategies = {'latency': ReadStrategy(0.2, readSize=16, lowLatency=True),
+                  'throughput': ReadStrategy(1.0, readSize=512, interByteTimeout=0.1),
+                  'event': ReadStrategy(1.0)}
+
+
+""" Return the read strategy of a name, the configured one by default """
+def getReadStrategy(name=None):
+    return readStrategies[name if name is not None else config.serialReadStrategy]
+
+
+""" Timeouts of a read strategy, as serial.Serial constructor arguments """
+def getPortSettings(strategy):
+    return dict(timeout=strategy.timeout, inter_byte_timeout=strategy.interByteTimeout)
+
+
+""" Apply the latency mode of a read strategy to an open port, its timeouts are given to the constructor (see getPortSettings) """
+def configurePort(conn, strategy):
+    if strategy.lowLatency:
+        try:
+            conn.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, ValueError, OSError):
+            pass  # not a USB serial adapter, or not supported on this platform
+
+
+""" Return the file descriptor of a port, None if it can't be read directly """
+def getDescriptor(conn):
+    if not hasattr(os, 'readv'):
+        return None
+    try:
+        return conn.fileno()
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+""" Read a port into buffer as its read strategy says, at least one byte (up to the port timeout), returns the count, 0 on timeout """
+def readInto(conn, buffer, strategy=None):
+    strategy = strategy if strategy is not None else getReadStrategy()
+    view = memoryview(buffer)
+    if strategy.readSize is not None:
+        view = view[:strategy.readSize]
+    fd = getDescriptor(conn)
+    if fd is None:
+        if strategy.interByteTimeout is None:
+            view = view[:max(1, min(conn.in_waiting, len(view)))]
+        return conn.readinto(view)  # the port has the inter-byte timeout, see configurePort
+    count = waitRead(conn, fd, view, conn.timeout)
+    if strategy.interByteTimeout is not None:
+        while 0 < count < len(view):
+            read = waitRead(conn, fd, view[count:], strategy.interByteTimeout)
+            if read == 0:
+                break
+            count += read
+    return count
+
+
+""" Wait up to timeout (s) for the descriptor of a port, read what's waiting into view, returns the count, 0 on timeout """
+def waitRead(conn, fd, view, timeout):
+    abortFd = getattr(conn, 'pipe_abort_read_r', None)
+    waitFds = [fd] if abortFd is None else [fd, abortFd]
+    while True:
+        try:
+            ready, _, _ = select.select(waitFds, [], [], timeout)
+            if abortFd in ready:
+                os.read(abortFd, 1000)  # cancel_read()
+                return 0
+            if not ready:
+                return 0
+            # the port is non blocking: readv returns what's waiting
+            count = os.readv(fd, [view])
+        except OSError as e:
+            if e.errno not in retryErrors:
+                raise serial.SerialException('read failed: {}'.format(e))
+            continue
+        if count == 0:
+            # a disconnected device is always ready but returns nothing
+            raise serial.SerialException('device reports readiness to read but returned no data')
+        return count
+
+
+""" Free list of preallocated read buffers, shared by a reader and the stage consuming its reads """
+class BufferPool():
+    def __init__(self, count, size):
+        self.size = size
+        self.free = deque(bytearray(size) for _ in range(count))
+
+    """ Take a free buffer, a new one if the pool is exhausted """
+    def acquire(self):
+        try:
+            return self.free.popleft()
+        except IndexError:
+            return bytearray(self.size)
+
+    """ Give a buffer back to the pool once its content is consumed """
+    def release(self, buffer):
+        self.free.append(buffer)
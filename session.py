@@ -0,0 +1,507 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file session.py
+#  @brief Recorded session: in-memory sample store, event log and file format
+#
+#  A session file (.oxs) is laid out as follows (little endian):
+#   - header: magic, format version, record size, start time (ns), nominal rate, firmware
+#   - samples: contiguous fixed-size records (time ns, pulse rate, SpO2, waveform, ...)
+#   - footer: tagged blocks (EVNT: event log, INDX: chunk index, PYRM: min/max pyramid levels,
+#     GAPS: samples lost in the stream)
+#   - trailer: sample count, footer offset, end magic
+#  A file without trailer (crashed recording) still exposes all complete samples.
+#  While recording, the events are also appended to a side file (<session>.events,
+#  eventStruct records) as they are logged, read back for a file without trailer and
+#  deleted once the footer is written.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import os
+import mmap
+import struct
+import bisect
+import re
+import datetime
+import numpy
+from array import array
+from enum import Enum
+import config
+import sampleclock
+import pyramid
+
+
+class ReaderEvent(Enum):
+    APNEA = 0
+    CONTRACTION = 1
+    BREATHE = 2
+    END = 3
+
+
+# file format
+fileMagic = b'OXSN'
+fileEndMagic = b'OXSE'
+fileVersion = 1
+headerStruct = struct.Struct('<4sHHqdB7x')
+recordStruct = struct.Struct('<qBBBBBB2x')
+blockStruct = struct.Struct('<4sQ')
+trailerStruct = struct.Struct('<QQ4s')
+eventStruct = struct.Struct('<qqB7x')
+indexStruct = struct.Struct('<qqq')
+pyramidLevelStruct = struct.Struct('<BBQ')
+gapStruct = struct.Struct('<qqq')
+# offset of the columns within a record
+timeOffset = 0
+pulseRateOffset = 8
+spO2Offset = 9
+pulseWaveformOffset = 10
+barGraphOffset = 11
+signalStrengthOffset = 12
+flagsOffset = 13
+# names of the record columns, in record order
+columnNames = ['time', 'pulseRate', 'spO2', 'pulseWaveform', 'barGraph', 'signalStrength', 'flags']
+columnOffsets = [timeOffset, pulseRateOffset, spO2Offset, pulseWaveformOffset, barGraphOffset, signalStrengthOffset, flagsOffset]
+columnFormats = ['<i8', 'u1', 'u1', 'u1', 'u1', 'u1', 'u1']
+# pyramid levels stored in a session file (finer ones are cheap to skip at read time)
+storedPyramidLevel = 2
+
+# flags packed in the last byte of a record, in getCsvColumns order
+flagBeep = 0x01
+flagFingerOut = 0x02
+flagSearching = 0x04
+flagDroppingSpO2 = 0x08
+flagProbeError = 0x10
+# first sample received after a reconnection (see supervisor.py)
+flagGap = 0x20
+
+
+""" NumPy structured type of a record (matches recordStruct), recordSize may be larger in newer files """
+def getRecordDtype(recordSize=recordStruct.size):
+    return numpy.dtype({'names': columnNames, 'formats': columnFormats, 'offsets': columnOffsets, 'itemsize': recordSize})
+
+
+""" Return the events whose sample index is within [start, end) from a sorted event list """
+def sliceEvents(events, start=0, end=None):
+    first = bisect.bisect_left(events, (start,))
+    last = len(events) if end is None else bisect.bisect_left(events, (end,))
+    return events[first:last]
+
+
+""" Return the gaps of a sequence of sample times (ns): (index of the sample after the gap, missing samples, duration ns)
+    previousTime is the time of the sample before the sequence, firstIndex the index of its first sample """
+def findGaps(times, period, previousTime=None, firstIndex=0):
+    times = numpy.asarray(times, dtype=numpy.int64)
+    if previousTime is not None:
+        times = numpy.concatenate(([previousTime], times))
+        firstIndex -= 1
+    if len(times) < 2:
+        return []
+    durations = numpy.diff(times)
+    missing = numpy.rint(durations / period).astype(numpy.int64) - 1
+    return [(firstIndex + int(i) + 1, int(missing[i]), int(durations[i])) for i in numpy.flatnonzero(missing > 0)]
+
+
+""" Return the (start, end) events of the holds, an APNEA followed by a BREATHE, from a sorted event list """
+def getHolds(events):
+    holds = []
+    start = None
+    for event in events:
+        if event[2] == ReaderEvent.APNEA.value:
+            start = event
+        elif event[2] == ReaderEvent.BREATHE.value and start is not None:
+            holds.append((start, event))
+            start = None
+    return holds
+
+
+""" Serialize the stored levels of pyramids, one per column id """
+def packPyramids(pyramids):
+    payload = bytearray()
+    for columnId, columnPyramid in enumerate(pyramids):
+        for level in range(storedPyramidLevel, len(columnPyramid.mins)):
+            mins, maxs = columnPyramid.mins[level], columnPyramid.maxs[level]
+            payload += pyramidLevelStruct.pack(columnId, level, len(mins))
+            payload += mins.tobytes() + maxs.tobytes()
+    return bytes(payload)
+
+
+""" Load serialized pyramid levels into pyramids, one per column id, as views of the payload """
+def unpackPyramids(payload, pyramids):
+    offset = 0
+    while offset + pyramidLevelStruct.size <= len(payload):
+        columnId, level, count = pyramidLevelStruct.unpack_from(payload, offset)
+        offset += pyramidLevelStruct.size
+        pyramids[columnId].setLevel(level, numpy.frombuffer(payload, numpy.uint8, count, offset), numpy.frombuffer(payload, numpy.uint8, count, offset + count))
+        offset += 2 * count
+
+
+""" Path of the event log written next to a session file while it's recorded """
+def getEventLogPath(path):
+    return path + '.events'
+
+
+""" Return the sorted events of the event log of a session file, empty without one """
+def readEventLog(path):
+    try:
+        with open(getEventLogPath(path), 'rb') as f:
+            payload = f.read()
+    except OSError:
+        return []
+    # a crash may have cut the last event
+    return sorted(eventStruct.iter_unpack(payload[:len(payload) - len(payload) % eventStruct.size]))
+
+
+""" Events of a session being recorded, appended and flushed to its event log one by one (see readEventLog) """
+class EventLog():
+    def __init__(self, path):
+        self.path = getEventLogPath(path)
+        self.file = None
+        # a log left by an earlier recording of the same path
+        self.remove()
+
+    def add(self, event):
+        if self.file is None:
+            self.file = open(self.path, 'wb')
+        self.file.write(eventStruct.pack(*event))
+        self.file.flush()
+
+    """ Close and delete the log, once its events are in the footer """
+    def remove(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+""" Build a default session file path in the configured session directory, suffixed by a device name if given """
+def defaultSessionPath(deviceName=None):
+    fileName = datetime.datetime.now().strftime('session_%Y%m%d_%H%M%S')
+    if deviceName:
+        fileName += '_' + re.sub(r'[^A-Za-z0-9]+', '', os.path.basename(deviceName))
+    return os.path.join(config.sessionDir, fileName + '.' + config.sessionFormat)
+
+
+""" Streaming writer of a session file """
+class SessionWriter():
+    def __init__(self, path, firmware, nominalRate, startTime):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(headerStruct.pack(fileMagic, fileVersion, recordStruct.size, startTime, nominalRate, firmware))
+        self.pending = bytearray()
+        self.pendingFirst = 0
+        self.pendingFirstTime = 0
+        self.pendingLastTime = 0
+        self.sampleCount = 0
+        self.index = []
+        self.eventLog = EventLog(path)
+
+    """ Append a record, the chunk is flushed to disk once full """
+    def addRecord(self, record):
+        if not self.pending:
+            self.pendingFirst = self.sampleCount
+            self.pendingFirstTime = record[0]
+        self.pendingLastTime = record[0]
+        self.pending += recordStruct.pack(*record)
+        self.sampleCount += 1
+        if self.sampleCount - self.pendingFirst >= config.sessionChunkSize:
+            self.flush()
+
+    """ Append a batch of records (structured array, see getRecordDtype), split on the chunk boundaries """
+    def addRecords(self, records):
+        start = 0
+        while start < len(records):
+            if not self.pending:
+                self.pendingFirst = self.sampleCount
+                self.pendingFirstTime = int(records['time'][start])
+            count = min(len(records) - start, config.sessionChunkSize - (self.sampleCount - self.pendingFirst))
+            batch = records[start:start + count]
+            self.pendingLastTime = int(batch['time'][-1])
+            self.pending += batch.astype(getRecordDtype(), copy=False).tobytes()
+            self.sampleCount += count
+            start += count
+            if self.sampleCount - self.pendingFirst >= config.sessionChunkSize:
+                self.flush()
+
+    """ Write the pending chunk and record it in the chunk index """
+    def flush(self):
+        if self.pending:
+            self.file.write(self.pending)
+            self.file.flush()
+            self.index.append((self.pendingFirst, self.pendingFirstTime, self.pendingLastTime))
+            self.pending = bytearray()
+
+    """ Log an event (sample index, time ns, event value) right away, the footer gets all of them on close """
+    def addEvent(self, event):
+        self.eventLog.add(event)
+
+    """ Write the footer blocks and close the file """
+    def close(self, events, pyramids, gaps=()):
+        if self.file is None:
+            return
+        self.flush()
+        footerOffset = self.file.tell()
+        self.writeBlock(b'EVNT', b''.join(eventStruct.pack(*event) for event in events))
+        self.writeBlock(b'INDX', b''.join(indexStruct.pack(*entry) for entry in self.index))
+        self.writeBlock(b'PYRM', packPyramids(pyramids))
+        self.writeBlock(b'GAPS', b''.join(gapStruct.pack(*gap) for gap in gaps))
+        self.file.write(trailerStruct.pack(self.sampleCount, footerOffset, fileEndMagic))
+        self.file.close()
+        self.file = None
+        self.eventLog.remove()
+
+    def writeBlock(self, tag, payload):
+        self.file.write(blockStruct.pack(tag, len(payload)))
+        self.file.write(payload)
+
+
+""" In-memory recorded session: sample columns and indexed event log """
+class Session():
+    def __init__(self, firmware=0, nominalRate=60.0, path=None):
+        self.firmware = firmware
+        self.nominalRate = nominalRate
+        self.times = array('q')
+        self.pulseRates = array('B')
+        self.spO2s = array('B')
+        self.pulseWaveforms = array('B')
+        self.barGraphs = array('B')
+        self.signalStrengths = array('B')
+        self.flags = array('B')
+        self.pulseRatePyramid = pyramid.MinMaxPyramid(self.pulseRates)
+        self.spO2Pyramid = pyramid.MinMaxPyramid(self.spO2s)
+        self.events = []  # (sample index, time ns, event value), sorted by sample index
+        self.gaps = []  # (index of the sample after the gap, missing samples, duration ns), see findGaps
+        self.writer = None
+        self.path = path
+
+    def __len__(self):
+        return len(self.times)
+
+    """ Append a live data point, returns its sample index """
+    def addSample(self, liveData):
+        record = (liveData.time, liveData.pulseRate, liveData.bloodSpO2, liveData.pulseWaveform, liveData.barGraph, liveData.signalStrength, liveData.flags)
+        if self.writer is None and self.path is not None:
+            self.writer = self.createWriter(liveData.time)
+        if self.writer is not None:
+            self.writer.addRecord(record)
+        if len(self.times) > 0 and liveData.time - self.times[-1] > 1.5e9 / self.nominalRate:
+            self.gaps += findGaps([liveData.time], 1e9 / self.nominalRate, self.times[-1], len(self.times))
+        self.times.append(liveData.time)
+        self.pulseRates.append(record[1])
+        self.spO2s.append(record[2])
+        self.pulseWaveforms.append(record[3])
+        self.barGraphs.append(record[4])
+        self.signalStrengths.append(record[5])
+        self.flags.append(record[6])
+        self.pulseRatePyramid.update()
+        self.spO2Pyramid.update()
+        return len(self.times) - 1
+
+    """ Append a batch of session records (structured array, see getRecordDtype), returns the index of the first one """
+    def addRecords(self, records):
+        self.writeRecords(records)
+        return self.appendRecords(records)
+
+    """ Write a batch of records to the session file only (the recorder stage of a pipeline) """
+    def writeRecords(self, records):
+        if len(records) == 0:
+            return
+        if self.writer is None and self.path is not None:
+            self.writer = self.createWriter(int(records['time'][0]))
+        if self.writer is not None:
+            self.writer.addRecords(records)
+
+    """ Append a batch of records to the columns only, returns the index of the first one """
+    def appendRecords(self, records):
+        first = len(self.times)
+        if len(records) == 0:
+            return first
+        self.gaps += findGaps(records['time'], 1e9 / self.nominalRate, self.times[-1] if first > 0 else None, first)
+        self.times.frombytes(numpy.ascontiguousarray(records['time'], dtype=numpy.int64).tobytes())
+        self.pulseRates.frombytes(records['pulseRate'].tobytes())
+        self.spO2s.frombytes(records['spO2'].tobytes())
+        self.pulseWaveforms.frombytes(records['pulseWaveform'].tobytes())
+        self.barGraphs.frombytes(records['barGraph'].tobytes())
+        self.signalStrengths.frombytes(records['signalStrength'].tobytes())
+        self.flags.frombytes(records['flags'].tobytes())
+        self.pulseRatePyramid.update()
+        self.spO2Pyramid.update()
+        return first
+
+    """ Writer of the session file, compressed for a .oxz path, with the events logged so far """
+    def createWriter(self, startTime):
+        if self.path.endswith('.oxz'):
+            import codec  # codec is built on this module
+            writer = codec.CompressedSessionWriter(self.path, self.firmware, self.nominalRate, startTime)
+        else:
+            writer = SessionWriter(self.path, self.firmware, self.nominalRate, startTime)
+        for entry in list(self.events):
+            writer.addEvent(entry)
+        return writer
+
+    """ Log an event at the given sample, offsetNs refines its time between two samples """
+    def addEvent(self, event, iSample, offsetNs=0):
+        if len(self.times) == 0:
+            eventTime = sampleclock.wallNs()
+        else:
+            eventTime = self.times[min(iSample, len(self.times) - 1)] + offsetNs
+        return self.logEvent((iSample, eventTime, event.value))
+
+    """ Log an event at a time (ns since epoch, see sampleclock.SampleClock), on the last sample stamped before it """
+    def addEventAt(self, event, eventTime):
+        iSample = max(0, bisect.bisect_right(self.times, eventTime) - 1)
+        return self.logEvent((iSample, eventTime, event.value))
+
+    """ Insert an event in the log, and in the event log of the session file once it's created """
+    def logEvent(self, entry):
+        bisect.insort(self.events, entry)
+        writer = self.writer
+        if writer is not None:
+            writer.addEvent(entry)
+        return entry
+
+    """ Return the events whose sample index is within [start, end) """
+    def getEvents(self, start=0, end=None):
+        return sliceEvents(self.events, start, end)
+
+    """ Gaps of the stream, see findGaps """
+    def getGaps(self):
+        return self.gaps
+
+    """ Average sample rate (hz) measured over the session """
+    def getSampleRate(self):
+        if len(self.times) < 2 or self.times[-1] == self.times[0]:
+            return self.nominalRate
+        return (len(self.times) - 1) * 1e9 / (self.times[-1] - self.times[0])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close(self.events, [self.pulseRatePyramid, self.spO2Pyramid], self.gaps)
+            self.writer = None
+
+
+""" Random access reader of a session file, columns are zero-copy NumPy views of the mapped file """
+class SessionReader():
+    # Opening only maps the file and reads its footer: the columns, the records and the stored
+    # pyramid levels all point into the map, pages are loaded by the OS when first read.
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.readFile()
+        except (struct.error, IndexError, OverflowError) as e:
+            # the map is released with the reader, views of it may still be referenced by the traceback
+            raise ValueError("Invalid session file: {0} ({1})".format(path, e))
+
+    """ Read the header and the footer blocks, map the columns """
+    def readFile(self):
+        magic, version, self.recordSize, self.startTime, self.nominalRate, self.firmware = headerStruct.unpack_from(self.map, 0)
+        if magic != fileMagic or version > fileVersion or self.recordSize < recordStruct.size:
+            raise ValueError("Invalid session file: " + self.path)
+        self.events = []
+        self.index = []
+        self.gaps = None
+        self.blocks = dict()
+        endMagic = b''
+        if len(self.map) >= headerStruct.size + trailerStruct.size:
+            self.sampleCount, footerOffset, endMagic = trailerStruct.unpack_from(self.map, len(self.map) - trailerStruct.size)
+        if endMagic == fileEndMagic:
+            self.readBlocks(footerOffset, len(self.map) - trailerStruct.size)
+        else:
+            # unterminated recording, keep every complete sample and the logged events
+            self.sampleCount = (len(self.map) - headerStruct.size) // self.recordSize
+            self.events = readEventLog(self.path)
+        if b'EVNT' in self.blocks:
+            self.events = sorted(eventStruct.iter_unpack(self.blocks[b'EVNT']))
+        if b'INDX' in self.blocks:
+            self.index = [entry for entry in indexStruct.iter_unpack(self.blocks[b'INDX'])]
+        if b'GAPS' in self.blocks:
+            self.gaps = list(gapStruct.iter_unpack(self.blocks[b'GAPS']))
+        self.records = numpy.frombuffer(self.map, getRecordDtype(self.recordSize), self.sampleCount, headerStruct.size)
+        self.times = self.records['time']
+        self.pulseRates = self.records['pulseRate']
+        self.spO2s = self.records['spO2']
+        self.pulseWaveforms = self.records['pulseWaveform']
+        self.barGraphs = self.records['barGraph']
+        self.signalStrengths = self.records['signalStrength']
+        self.flags = self.records['flags']
+        self.pulseRatePyramid = pyramid.MinMaxPyramid(self.pulseRates)
+        self.spO2Pyramid = pyramid.MinMaxPyramid(self.spO2s)
+        if b'PYRM' in self.blocks:
+            unpackPyramids(self.blocks[b'PYRM'], [self.pulseRatePyramid, self.spO2Pyramid])
+        else:
+            self.pulseRatePyramid.update()
+            self.spO2Pyramid.update()
+
+    def __len__(self):
+        return self.sampleCount
+
+    def readBlocks(self, offset, end):
+        while offset + blockStruct.size <= end:
+            tag, length = blockStruct.unpack_from(self.map, offset)
+            offset += blockStruct.size
+            self.blocks[tag] = memoryview(self.map)[offset:offset + length]
+            offset += length
+
+    """ Return the records within [start, end) as tuples """
+    def getRecords(self, start=0, end=None):
+        end = self.sampleCount if end is None else min(end, self.sampleCount)
+        begin = headerStruct.size + start * self.recordSize
+        return list(recordStruct.iter_unpack(self.map[begin:headerStruct.size + end * self.recordSize]))
+
+    """ Return the index of the first sample at or after the given time (ns) """
+    def findSample(self, sampleTime):
+        # the chunk index narrows the search to one chunk, only its pages are read
+        iChunk = max(0, bisect.bisect_right([entry[1] for entry in self.index], sampleTime) - 1)
+        start = self.index[iChunk][0] if self.index else 0
+        end = self.index[iChunk + 1][0] if iChunk + 1 < len(self.index) else self.sampleCount
+        if start < end and self.times[end - 1] < sampleTime:
+            return end
+        return start + int(numpy.searchsorted(self.times[start:end], sampleTime))
+
+    """ Return the sample range [start, end) recorded within the time range [startTime, endTime) (ns) """
+    def getTimeRange(self, startTime, endTime):
+        return self.findSample(startTime), self.findSample(endTime)
+
+    """ Return the records (structured array view) recorded within the time range [startTime, endTime) (ns) """
+    def sliceTime(self, startTime, endTime):
+        start, end = self.getTimeRange(startTime, endTime)
+        return self.records[start:end]
+
+    """ Return the events whose sample index is within [start, end) """
+    def getEvents(self, start=0, end=None):
+        return sliceEvents(self.events, start, end)
+
+    """ Gaps of the stream, see findGaps, found from the sample times in files recorded without them """
+    def getGaps(self):
+        if self.gaps is None:
+            self.gaps = findGaps(self.times, 1e9 / self.nominalRate)
+        return self.gaps
+
+    """ Average sample rate (hz) measured over the session """
+    def getSampleRate(self):
+        if self.sampleCount < 2 or self.times[-1] == self.times[0]:
+            return self.nominalRate
+        return (self.sampleCount - 1) * 1e9 / (int(self.times[-1]) - int(self.times[0]))
+
+    def close(self):
+        # the views must be dropped before the map can be closed
+        self.pulseRatePyramid = None
+        self.spO2Pyramid = None
+        self.records = None
+        for name in ('times', 'pulseRates', 'spO2s', 'pulseWaveforms', 'barGraphs', 'signalStrengths', 'flags'):
+            setattr(self, name, None)
+        try:
+            for block in self.blocks.values():
+                block.release()
+            self.blocks = dict()
+            self.map.close()
+        except BufferError:
+            # arrays taken from the reader are still alive, the map is closed with the last of them
+            pass
@@ -0,0 +1,126 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file supervisor.py
+#  @brief Automatic reconnection of a stalled or failed oximeter
+#
+#  The supervisor stands for the driver in the acquisition pipeline. When
+#  nothing was read for stallTimeout seconds, or the reads of stallTimeout
+#  seconds held no frame, or the port fails (USB hiccup, device
+#  unplugged), it closes the port, waits, reopens it (the
+#  v4.6 driver sends its handshake again) and resumes into the same
+#  session. The wait doubles on every failed attempt, between
+#  reconnectMinDelay and reconnectMaxDelay. The stream state (clock, rate,
+#  incomplete frame) is reset by the decoder, once it's done with the reads
+#  queued before the reconnection (see takeStreamReset). The first sample
+#  after a reconnection carries session.flagGap. Both stall checks run on
+#  the times the bytes were read, so a decoder held up by a slow sink
+#  (disk stall of the recorder) is not mistaken for a silent device.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import time
+import config
+import session
+import sampleclock
+
+
+""" Reader / decoder of a driver for a pipeline, reconnecting the port until isActive() is False """
+class ConnectionSupervisor():
+    def __init__(self, driver, port, isActive):
+        self.driver = driver
+        self.port = port
+        self.isActive = isActive
+        self.rateMeter = driver.rateMeter
+        self.clock = driver.clock
+        self.delay = config.reconnectMinDelay
+        self.lastFrame = sampleclock.monotonicNs()  # read time of the last bytes holding a frame
+        self.lastDecoded = self.lastFrame  # read time of the last bytes decoded
+        self.lastRead = self.lastFrame
+        self.reconnecting = False
+        self.reconnectCount = 0  # failed attempts since the last decoded frame
+        self.resetPending = False  # reconnected, the next read starts a new stream
+        self.gapPending = False
+
+    """ Read into buffer like the driver, only returns 0 once stopped """
+    def readInto(self, buffer):
+        while self.isActive():
+            if self.driver.isConnected():
+                try:
+                    count = self.driver.pollInto(buffer)
+                    failed = False
+                except Exception:
+                    count = 0
+                    failed = True
+                now = sampleclock.monotonicNs()
+                if count > 0:
+                    self.lastRead = now
+                silent = now - self.lastRead > config.stallTimeout * 1e9
+                stalled = self.lastDecoded - self.lastFrame > config.stallTimeout * 1e9
+                if not failed and not silent and not stalled:
+                    if count > 0:
+                        return count
+                    continue
+            self.reconnect()
+        return 0
+
+    """ True once after a reconnection: the reads that follow must be decoded after resetStream, called from the reader """
+    def takeStreamReset(self):
+        reset, self.resetPending = self.resetPending, False
+        return reset
+
+    """ Reset the stream state of the driver, called from the decoder between the reads of two connections """
+    def resetStream(self):
+        self.driver.resetStream()
+        self.gapPending = True
+
+    """ Decode like the driver, marks the first sample after a reconnection """
+    def decodeData(self, data, now):
+        records = self.driver.decodeData(data, now)
+        # reads queued before a reconnection are older than its times
+        self.lastDecoded = max(self.lastDecoded, now)
+        if len(records):
+            self.lastFrame = max(self.lastFrame, now)
+            self.delay = config.reconnectMinDelay
+            self.reconnectCount = 0
+            if self.gapPending:
+                records['flags'][0] |= session.flagGap
+                self.gapPending = False
+        return records
+
+    """ Close the port, wait the current delay, then reopen it, the delay doubles for the next attempt """
+    def reconnect(self):
+        self.reconnecting = True
+        self.driver.disconnect()
+        waitEnd = time.monotonic() + self.delay
+        while self.isActive() and time.monotonic() < waitEnd:
+            time.sleep(min(0.1, max(0.0, waitEnd - time.monotonic())))
+        if not self.isActive():
+            return
+        self.delay = min(self.delay * 2, config.reconnectMaxDelay)
+        self.reconnectCount += 1
+        try:
+            # the decoder may still be decoding older reads, it resets the stream itself
+            self.driver.open(self.port)
+        except Exception:
+            pass
+        self.lastFrame = self.lastDecoded = self.lastRead = sampleclock.monotonicNs()
+        self.resetPending = True
+        self.reconnecting = not self.driver.isConnected()
+
+    def isConnected(self):
+        return self.driver.isConnected()
+
+    def disconnect(self):
+        self.driver.disconnect()
+
+
+""" Return what a pipeline reads: the driver, supervised when autoReconnect is enabled """
+def supervise(driver, port, isActive):
+    if config.autoReconnect:
+        return ConnectionSupervisor(driver, port, isActive)
+    return driver
@@ -10,178 +10,130 @@
 #**************************************************************************
 
 #!/usr/bin/env python3
-import cms50v45
-import cms50v46
 import utils
 import config
+import session
+import codec
+import sampleclock
+import pipeline
+import samplebus
+import supervisor
+import glviews
+import scheduler
 import datetime
-import math
-from enum import Enum
+import time
+from collections import deque
 from functools import partial
-from threading import Thread, Lock
+from threading import Thread
+from session import ReaderEvent
+from acquisition import OximeterVersion, createDriver
 from Qtpy.Qt import QtCore, QtGui, QtWidgets
 
 
-class ReaderEvent(Enum):
-    APNEA = 0
-    CONTRACTION = 1
-    BREATHE = 2
-    END = 3
-
-
-class OximeterVersion(Enum):
-    FOURFIVE = 0
-    FOURSIX = 1
-    END = 3
-
-
 """ Reader UI Updater in a separate thread """
 class ReaderUIUpdater(Thread):
     def __init__(self, ui, port, version):
         Thread.__init__(self)
         # Connect to the oximeter
         self.ui = ui
-        if version == OximeterVersion.FOURFIVE:
-            self.oximeter = cms50v45.CMS50DDriver()
-        else:
-            self.oximeter = cms50v46.CMS50DDriver()
+        self.oximeter = createDriver(version)
         self.oximeter.connect(port)
         self.threadActive = self.oximeter.isConnected()
-        self.eventLock = Lock()
-        # reset images
-        self.ui.pulseImage.fill(config.dfltBkgColor)
-        self.ui.bpmImage.fill(config.dfltBkgColor)
         # Config & internal var
-        self.events = []
+        self.events = deque()  # (event, monotonic time), append/popleft are atomic
+        self.session = session.Session(version.value, self.oximeter.sampleRate, session.defaultSessionPath() if config.recordSession else None)
         self.apneaTime = None
         self.apneaStatus = ReaderEvent.END
-        self.pulseMaxValue = 100
-        self.bpmMaxValue = 127
-        self.o2MaxValue = 127
-        self.pulseFrequency = 2  # how many samples we skip
-        self.bpmFrequency = 60  # based on quick calculation, the oxymeter runs at 60hz
-        self.updateRate = int(self.bpmFrequency / (self.ui.bpmImage.width() / (int(self.ui.minuteField.value()) * 60)))
-        self.drawBpmLines()
-        self.previousYPulse = 0
-
-    """ Update the pulse images """
-    def updatePulseImage(self, iSample, liveDataSample):
-        pulseValue = min(liveDataSample[3], self.pulseMaxValue)
-        pulseXPixel = iSample % self.ui.pulseImage.width()
-        pulseYPixel = int(pulseValue / self.pulseMaxValue * self.ui.pulseImage.height())
-        #pixelColor = QtGui.QColor()
-        #pixelColor.setHsl(pulseYPixel / self.ui.pulseImage.height() * 255, 255, 127)
-        pixelColor = config.pulseColor
-        lineShift = int((pulseYPixel - self.previousYPulse) / 2)
-        # clean pulse image
-        bandWidth = int(self.ui.pulseImage.width() * 0.2)
-        utils.drawBox(self.ui.pulseImage, pulseXPixel + bandWidth / 2, self.ui.pulseImage.height() / 2, bandWidth, self.ui.pulseImage.height(), config.dfltBkgColor)
-        # update pulse image
-        utils.drawBox(self.ui.pulseImage, pulseXPixel, self.ui.pulseImage.height() - pulseYPixel - 1 + lineShift, config.curvePixelSize, config.curvePixelSize + abs(lineShift * 2), pixelColor)
-        self.ui.pulseImageHolder.setPixmap(QtGui.QPixmap.fromImage(self.ui.pulseImage))
-        self.previousYPulse = pulseYPixel
-
-    """ Update the bpm image """
-    def updateBpmImage(self, iSample, liveDataSample):
-        bpmValue = min(liveDataSample[1], self.bpmMaxValue)
-        bpmXPixel = iSample
-        bpmYPixel = int(bpmValue / self.bpmMaxValue * self.ui.bpmImage.height())
-        o2Value = min(liveDataSample[2], self.o2MaxValue)
-        o2XPixel = iSample
-        o2YPixel = int(o2Value / self.o2MaxValue * self.ui.bpmImage.height())
-        # draw pixel
-        utils.drawBox(self.ui.bpmImage, bpmXPixel, self.ui.bpmImage.height() - bpmYPixel - 1, config.curvePixelSize, config.curvePixelSize, config.bmpColor)
-        utils.drawBox(self.ui.bpmImage, o2XPixel, self.ui.bpmImage.height() - o2YPixel - 1, config.curvePixelSize, config.curvePixelSize, config.o2Color)
-        self.ui.bpmImageHolder.setPixmap(QtGui.QPixmap.fromImage(self.ui.bpmImage))
-
-    """ Update the bpm image with an event line """
-    def drawLineBpmImage(self, iSample, color):
-        utils.drawBox(self.ui.bpmImage, iSample, self.ui.bpmImage.height() / 2, config.curvePixelSize + 2, self.ui.bpmImage.height(), color)
-
-    """ Draw the time cols """
-    def drawTimeCols(self, iSample):
-        colSampleSize = math.ceil(self.ui.bpmImage.width() / (self.ui.minuteField.value() * 60) * config.timeColFrequency)
-        for iGrid in range(iSample, self.ui.bpmImage.width(), colSampleSize):
-            utils.drawBox(self.ui.bpmImage, iGrid, self.ui.bpmImage.height() / 2, 1, self.ui.bpmImage.height(), config.gridColColor)
-
-    """ Draw the bpm lines """
-    def drawBpmLines(self):
-        lineSampleSize = math.ceil(self.ui.bpmImage.height() / self.bpmMaxValue * config.bpmLineFrequency)
-        for iGrid in range(0, self.ui.bpmImage.height(), lineSampleSize):
-            utils.drawBox(self.ui.bpmImage, self.ui.bpmImage.width() / 2, self.ui.bpmImage.height() - iGrid -1, self.ui.bpmImage.width(), 1, config.gridLineColor)
-        # draw a specific line for the mark 100
-        lineSamplePixel = math.ceil(self.ui.bpmImage.height() / self.bpmMaxValue * 100)
-        utils.drawBox(self.ui.bpmImage, self.ui.bpmImage.width() / 2, self.ui.bpmImage.height() - lineSamplePixel - 1, self.ui.bpmImage.width(), 1, config.gridLine100Color)
+        self.error = None  # exception that stopped the acquisition
+        # the in-memory session must not miss a sample, the recorder absorbs a slow disk in its own queue
+        sinks = [pipeline.Sink('session', self.session.appendRecords, config.sessionQueueSize, pipeline.QueuePolicy.BLOCK),
+                 pipeline.Sink('recorder', self.session.writeRecords, config.recorderQueueSize, pipeline.QueuePolicy.BLOCK)]
+        self.bus = None
+        if config.sampleBus:
+            busSink, self.bus = samplebus.createSink(port, self.oximeter)
+            sinks.append(busSink)
+        self.supervisor = supervisor.supervise(self.oximeter, port, lambda: self.threadActive)
+        self.pipeline = pipeline.Pipeline(self.supervisor, sinks)
 
     """ Update time """
     def updateTimer(self):
         if self.apneaStatus == ReaderEvent.APNEA:
-            deltaDatetime = datetime.datetime.now() - self.apneaTime
+            deltaDatetime = datetime.timedelta(seconds=time.monotonic() - self.apneaTime)
             deltaTime = (datetime.datetime.min + deltaDatetime).time()
             self.ui.timeValueLabel.setText(deltaTime.strftime('%M:%S'))
         elif self.apneaStatus == ReaderEvent.END:
             self.ui.timeValueLabel.setText('--')
 
 
-    """ check the oximeter status and update the ui """
+    """ check the oximeter status and update the ui, called from the ui thread """
     def checkOximeterStatus(self):
-        if self.oximeter.isConnected() is True:
-            if self.threadActive is True:
-                self.ui.footerLabel.setText('Oximeter Status: Connected')
-                self.ui.refreshApneaUI(True)
-                return True
-            else:
-                self.ui.footerLabel.setText('Oximeter Status: Not Connected (Manual deconnection)')
-                self.oximeter.disconnect()
-                self.ui.refreshApneaUI(False)
-                return False
-        self.ui.footerLabel.setText('Oximeter Status: Not Connected (No package sent)')
+        if self.threadActive is True and getattr(self.supervisor, 'reconnecting', False):
+            self.ui.footerLabel.setText('Oximeter Status: Reconnecting (attempt {0})'.format(self.supervisor.reconnectCount + 1))
+            return True
+        if self.oximeter.isConnected() is True and self.threadActive is True:
+            self.updateHealth()
+            self.ui.refreshApneaUI(True)
+            return True
+        if self.error is not None:
+            self.ui.footerLabel.setText('Oximeter Status: Not Connected (Error: {0})'.format(self.error))
+        else:
+            self.ui.footerLabel.setText('Oximeter Status: Not Connected (No package sent)')
         self.ui.refreshApneaUI(False)
         return False
 
-
-    """ thread safe event feeder """
+    """ Show the last received values, called from the ui thread """
+    def updateValues(self):
+        sampleCount = len(self.session)
+        if sampleCount > 0 and self.oximeter.isConnected():
+            self.ui.bpmValueLabel.setText(str(self.session.pulseRates[sampleCount - 1]))
+            self.ui.o2ValueLabel.setText(str(self.session.spO2s[sampleCount - 1]) + '%')
+            self.updateTimer()
+
+    """ Report the measured rate and the health of the stream """
+    def updateHealth(self):
+        health = self.oximeter.rateMeter.getHealth()
+        rate = self.oximeter.rateMeter.getRate()
+        if health == sampleclock.RateHealth.STALLED:
+            status = 'Oximeter Status: Connected (Stalled, no package for a while)'
+        elif health == sampleclock.RateHealth.OK:
+            status = 'Oximeter Status: Connected ({0:.1f} Hz)'.format(rate)
+        else:
+            status = 'Oximeter Status: Connected ({0:.1f} Hz, {1})'.format(rate, health.name.lower())
+        droppedReads = self.pipeline.getDroppedReads()
+        if droppedReads:
+            status += ' - {0} reads dropped'.format(droppedReads)
+        droppedBatches = self.pipeline.getDroppedBatches()
+        if droppedBatches:
+            status += ' - {0} batches dropped'.format(droppedBatches)
+        lost = self.oximeter.stats.getLostFrames()
+        if lost:
+            status += ' - {0} frames lost ({1:.2%})'.format(lost, self.oximeter.stats.getLossRatio())
+        self.ui.footerLabel.setText(status)
+
+    """ thread safe event feeder, stamps the event with the time it was pressed """
     def feedEvent(self, event):
-        self.eventLock.acquire()
-        self.events.append(event)
-        self.eventLock.release()
-
-    """ thread sage event consumer """
-    def consumeEvent(self, iSample):
-        self.eventLock.acquire()
-        for event in self.events:
+        self.events.append((event, time.monotonic()))
+
+    """ Event consumer, called from the ui frames (samples or not) and once the acquisition stopped """
+    def consumeEvent(self):
+        while self.events:
+            event, eventTime = self.events.popleft()
+            # the sample stamps are wall times, log the event at its press time on the sample clock
+            self.session.addEventAt(event, int(eventTime * 1e9) + self.oximeter.clock.wallOffset)
             if event == ReaderEvent.APNEA:
-                self.apneaTime = datetime.datetime.now()
-                self.drawLineBpmImage(iSample, config.apneaColor)
-                self.drawTimeCols(iSample)
+                self.apneaTime = eventTime
                 self.apneaStatus = ReaderEvent.APNEA
-            elif event == ReaderEvent.CONTRACTION:
-                self.drawLineBpmImage(iSample, config.contractionColor)
             elif event == ReaderEvent.BREATHE:
-                self.drawLineBpmImage(iSample, config.breatheColor)
                 self.apneaStatus = ReaderEvent.BREATHE
-        self.events.clear()
-        self.eventLock.release()
 
-    """ Main thread run, read the packet loop """
+    """ Main thread run: reads the port, the pipeline decodes and records, the ui pulls what it shows from the session """
     def run(self):
-        iSample = 0
-        for liveData in self.oximeter.getLiveData():
-            # print(liveData)
-            if self.checkOximeterStatus() is False:
-                return
-            liveDataSample = liveData.getCsvData()
-            self.ui.bpmValueLabel.setText(str(liveDataSample[1]))
-            self.ui.o2ValueLabel.setText(str(liveDataSample[2]) + '%')
-            if iSample % self.pulseFrequency == 0:
-                self.updatePulseImage(int(iSample / self.pulseFrequency), liveDataSample)
-            if iSample % self.updateRate == 0:
-                self.consumeEvent(int(iSample / self.updateRate))
-                self.updateBpmImage(int(iSample / self.updateRate), liveDataSample)
-                self.updateTimer()
-            iSample += 1
+        self.error = self.pipeline.run(lambda: self.threadActive)
+        self.consumeEvent()
+        self.session.close()
+        if self.bus is not None:
+            self.bus.close()
         self.oximeter.disconnect()
-        self.checkOximeterStatus()
 
 
 """ Main QT Application """
@@ -229,6 +181,10 @@ class ReaderUI(QtWidgets.QMainWindow):
         self.disconnectButton = QtWidgets.QPushButton()
         self.disconnectButton.setIcon(QtGui.QIcon(utils.getIconsDir() + 'disconnect.png'))
         self.disconnectButton.setFixedWidth(25)
+        self.openButton = QtWidgets.QPushButton()
+        self.openButton.setIcon(self.style().standardIcon(QtWidgets.QStyle.SP_DialogOpenButton))
+        self.openButton.setToolTip('Open a recorded session')
+        self.openButton.setFixedWidth(25)
         connectLayout.addWidget(portLabel)
         connectLayout.addWidget(self.refreshButton)
         connectLayout.addWidget(self.portCombo)
@@ -237,6 +193,7 @@ class ReaderUI(QtWidgets.QMainWindow):
         connectLayout.addWidget(minuteLabel)
         connectLayout.addWidget(self.connectButton)
         connectLayout.addWidget(self.disconnectButton)
+        connectLayout.addWidget(self.openButton)
         centralLayout.addWidget(connectWidget, iLine, 0, QtCore.Qt.AlignLeft)
         iLine += 1
 
@@ -261,19 +218,15 @@ class ReaderUI(QtWidgets.QMainWindow):
         controlLayout.addWidget(self.resetButton)
         bottomLayout.addWidget(controlWidget, 0, 0, QtCore.Qt.AlignTop)
 
-        # pulse curve image
-        self.pulseImage = QtGui.QImage(config.widthPulseImage, self.bmpImageSize.height(), QtGui.QImage.Format_RGB32)
-        self.pulseImage.fill(config.dfltBkgColor)
-        self.pulseImageHolder = QtWidgets.QLabel()
-        self.pulseImageHolder.setPixmap(QtGui.QPixmap.fromImage(self.pulseImage))
-        bottomLayout.addWidget(self.pulseImageHolder, 0, 1)
+        # pulse curve
+        self.pulseView = glviews.createPulseView(QtCore.QSize(config.widthPulseImage, self.bmpImageSize.height()))
+        bottomLayout.addWidget(self.pulseView, 0, 1)
 
-        # o2 bpm image
-        self.bpmImage = QtGui.QImage(self.bmpImageSize, QtGui.QImage.Format_RGB32)
-        self.bpmImage.fill(config.dfltBkgColor)
-        self.bpmImageHolder = QtWidgets.QLabel()
-        self.bpmImageHolder.setPixmap(QtGui.QPixmap.fromImage(self.bpmImage))
-        bottomLayout.addWidget(self.bpmImageHolder, 0, 2)
+        # o2 bpm history
+        self.historyView = glviews.createHistoryView(self.bmpImageSize)
+        self.historyView.setWindow(self.minuteField.value() * 60)
+        bottomLayout.addWidget(self.historyView, 0, 2)
+        bottomLayout.setColumnStretch(2, 1)
 
         # o2 / bpm label
         dataWidget = QtWidgets.QWidget()
@@ -312,12 +265,21 @@ class ReaderUI(QtWidgets.QMainWindow):
 
         # Device Manager
         self.readThread = None
+        self.healthTimer = QtCore.QTimer(self)
+        self.healthTimer.timeout.connect(self.checkHealth)
+        self.healthTimer.start(config.healthCheckPeriod)
+        self.renderScheduler = scheduler.RenderScheduler(config.renderFrequency, self)
+        self.renderScheduler.addView(self.historyView)
+        self.renderScheduler.addView(self.pulseView)
+        self.renderScheduler.addView(self)
 
         # Connect UI
         self.refreshButton.clicked.connect(self.refreshSerialPorts)
         self.connectButton.clicked.connect(self.startThread)
         self.disconnectButton.clicked.connect(self.stopThread)
         self.resetButton.clicked.connect(self.resetThread)
+        self.openButton.clicked.connect(self.openSession)
+        self.minuteField.valueChanged.connect(self.setMinutes)
         self.apneaButton.clicked.connect(partial(self.sendEvent, ReaderEvent.APNEA))
         self.contractionButton.clicked.connect(partial(self.sendEvent, ReaderEvent.CONTRACTION))
         self.breatheButton.clicked.connect(partial(self.sendEvent, ReaderEvent.BREATHE))
@@ -337,16 +299,6 @@ class ReaderUI(QtWidgets.QMainWindow):
             self.windowSize = self.size()
             self.setMinimumSize(self.windowSize)
 
-    # Resize Event
-    def resizeEvent(self, event):
-        if self.threadIsActive() is False and self.windowSize is not None:
-            self.bpmImage = QtGui.QImage(self.bmpImageSize + self.size() - self.windowSize, QtGui.QImage.Format_RGB32)
-            self.bpmImage.fill(config.dfltBkgColor)
-            self.bpmImageHolder.setPixmap(QtGui.QPixmap.fromImage(self.bpmImage))
-            self.pulseImage = QtGui.QImage(config.widthPulseImage, self.bpmImage.height(), QtGui.QImage.Format_RGB32)
-            self.pulseImage.fill(config.dfltBkgColor)
-            self.pulseImageHolder.setPixmap(QtGui.QPixmap.fromImage(self.pulseImage))
-
     def refreshUI(self):
         self.refreshSerialPorts()
         self.refreshApneaUI(False)
@@ -373,6 +325,7 @@ class ReaderUI(QtWidgets.QMainWindow):
             port = self.portCombo.currentText()
             version = OximeterVersion(self.versionCombo.currentIndex())
             self.readThread = ReaderUIUpdater(self, port, version)
+            self.setSource(self.readThread.session, self.readThread.oximeter.rateMeter)
             self.readThread.start()
 
     def stopThread(self):
@@ -380,13 +333,42 @@ class ReaderUI(QtWidgets.QMainWindow):
             self.readThread.threadActive = False
             self.readThread.join()
             self.readThread = None
+            self.footerLabel.setText('Oximeter Status: Not Connected (Manual deconnection)')
+            self.refreshApneaUI(False)
 
     def resetThread(self):
         self.stopThread()
         self.startThread()
 
+    def setMinutes(self, minutes):
+        self.historyView.setWindow(minutes * 60)
+
+    """ Show a session in the views, rateMeter measures the rate of a live one """
+    def setSource(self, source, rateMeter=None):
+        previousSource = self.historyView.source
+        self.historyView.setSource(source)
+        self.pulseView.setSource(source, rateMeter)
+        if isinstance(previousSource, (session.SessionReader, codec.CompressedSessionReader)):
+            previousSource.close()
+
+    def openSession(self):
+        if self.threadIsActive() is False:
+            path = QtWidgets.QFileDialog.getOpenFileName(self, 'Open Session', config.sessionDir, 'Sessions (*.oxs *.oxz)')[0]
+            if path:
+                self.setSource(codec.openSession(path))
+
     def sendEvent(self, event):
         self.readThread.feedEvent(event)
 
+    def checkHealth(self):
+        if self.readThread is not None:
+            self.readThread.checkOximeterStatus()
+
+    """ Render frame: show the last values of the acquisition """
+    def refresh(self):
+        if self.threadIsActive() is True:
+            self.readThread.consumeEvent()
+            self.readThread.updateValues()
+
     def threadIsActive(self):
         return (self.readThread is not None and self.readThread.threadActive is True)
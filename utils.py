@@ -14,6 +14,8 @@ import os
 import sys
 import glob
 import serial
+import numpy
+from Qtpy.Qt import QtCore, QtGui
 
 """ Lists serial port names
 
@@ -58,12 +60,36 @@ def getIconsDir():
     return (getScriptPath() + 'icons/')
 
 
-""" Draw a 2d box """
-def drawBox(image, xValue, yValue, xSize, ySize, color):
-    #image.setPixelColor(min(image.width() - 1, xValue), min(image.height() - 1, yValue), color)
-    for iX in range(int(xValue - (xSize - 1) / 2), int(xValue + (xSize - 1) / 2) + 1):
-        for iY in range(int(yValue - (ySize - 1) / 2), int(yValue + (ySize - 1) / 2) + 1):
-            image.setPixelColor(clamp(0, iX, image.width() - 1), clamp(0, iY, image.height() - 1), color)
+""" Build a QPolygonF from x / y NumPy arrays, filled in place through a view of its buffer when the binding allows """
+def createPolygon(xValues, yValues):
+    count = len(xValues)
+    polygon = QtGui.QPolygonF(count)
+    if hasattr(polygon, 'data'):
+        # PyQt: the points are contiguous (x, y) doubles
+        buffer = polygon.data()
+        buffer.setsize(count * 2 * numpy.dtype(numpy.float64).itemsize)
+        points = numpy.frombuffer(buffer, dtype=numpy.float64).reshape(count, 2)
+        points[:, 0] = xValues
+        points[:, 1] = yValues
+    else:
+        for iPoint, (x, y) in enumerate(zip(xValues.tolist(), yValues.tolist())):
+            polygon[iPoint] = QtCore.QPointF(x, y)
+    return polygon
+
+
+""" Draw a polyline through x / y NumPy arrays in a single call, for curves moving forward in x: the antialiased
+    stroker gets very slow on long self-overlapping lines, min / max columns go through drawSegments """
+def drawPolyline(painter, xValues, yValues):
+    if len(xValues) > 1:
+        painter.drawPolyline(createPolygon(xValues, yValues))
+
+
+""" Draw the segments (x0, y0) -> (x1, y1) of x / y NumPy arrays in a single call """
+def drawSegments(painter, x0Values, y0Values, x1Values, y1Values):
+    if len(x0Values) > 0:
+        xValues = numpy.column_stack((x0Values, x1Values)).ravel()
+        yValues = numpy.column_stack((y0Values, y1Values)).ravel()
+        painter.drawLines(createPolygon(xValues, yValues))
 
 
 """ Set the border color of a push button """
@@ -0,0 +1,479 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file views.py
+#  @brief Curve views rendered from a recorded session
+#**************************************************************************
+
+#!/usr/bin/env python3
+import math
+import bisect
+import numpy
+import config
+import utils
+from threading import Thread, Lock
+from session import ReaderEvent
+from Qtpy.Qt import QtCore, QtGui, QtWidgets
+
+# color of the event lines, by event value
+eventColors = {ReaderEvent.APNEA.value: config.apneaColor, ReaderEvent.CONTRACTION.value: config.contractionColor, ReaderEvent.BREATHE.value: config.breatheColor}
+
+
+""" Draw the pulse pixels [firstPixel, lastPixel] of a sweep, pixel p shows the sample p * decimation at x = p % width """
+def drawPulsePixels(painter, source, decimation, width, height, firstPixel, lastPixel, pulseMaxValue):
+    pen = QtGui.QPen(config.pulseColor, config.curvePixelSize)
+    pen.setJoinStyle(QtCore.Qt.RoundJoin)
+    pen.setCapStyle(QtCore.Qt.RoundCap)
+    painter.setPen(pen)
+    painter.setRenderHint(QtGui.QPainter.Antialiasing)
+    # start from the previous pixel to join the curve already drawn, unless it sits on the other edge
+    if firstPixel > 0 and firstPixel % width != 0:
+        firstPixel -= 1
+    values = numpy.array(source.pulseWaveforms[firstPixel * decimation:lastPixel * decimation + 1:decimation], dtype=numpy.float64)
+    pixels = numpy.arange(firstPixel, firstPixel + len(values))
+    xValues = pixels % width
+    yValues = height - numpy.minimum(values, pulseMaxValue) / pulseMaxValue * height - 1
+    # one polyline per sweep
+    for segment in numpy.split(numpy.arange(len(values)), numpy.flatnonzero(xValues[1:] == 0) + 1):
+        utils.drawPolyline(painter, xValues[segment], yValues[segment])
+
+
+""" Samples per pulse pixel at the given sample rate (hz) """
+def getPulseDecimation(rate):
+    return max(1, round(rate / config.pulsePixelRate))
+
+
+""" Draw (min, max) columns spread over rect: a vertical segment per non empty (not None) column, in a single call """
+def drawColumns(painter, columns, rect, maxValue, color, width=config.curvePixelSize):
+    # The segments are stretched to the range of their left neighbour so a run of columns reads as one curve.
+    # Unlike a zig-zag polyline through the mins and maxs, the cost only depends on the number of columns,
+    # not on how much the values swing. Columns wider than the pen are also joined by a polyline through
+    # their centres, they hold a single sample or so.
+    valid = numpy.array([minMax is not None for minMax in columns])
+    if not valid.any():
+        return
+    minMaxs = numpy.array([minMax if minMax is not None else (0, 0) for minMax in columns], dtype=numpy.float64)
+    lows, highs = minMaxs[:, 0].copy(), minMaxs[:, 1].copy()
+    joined = numpy.flatnonzero(valid[1:] & valid[:-1]) + 1
+    lows[joined] = numpy.minimum(minMaxs[joined, 0], minMaxs[joined - 1, 1])
+    highs[joined] = numpy.maximum(minMaxs[joined, 1], minMaxs[joined - 1, 0])
+    spacing = rect.width() / len(columns)
+    xValues = rect.left() + (numpy.arange(len(columns)) + 0.5) * spacing
+    toY = lambda values: rect.bottom() - numpy.minimum(values, maxValue) / maxValue * rect.height() - 1
+    pen = QtGui.QPen(color, width)
+    pen.setJoinStyle(QtCore.Qt.RoundJoin)
+    pen.setCapStyle(QtCore.Qt.RoundCap)
+    painter.setPen(pen)
+    painter.setRenderHint(QtGui.QPainter.Antialiasing)
+    utils.drawSegments(painter, xValues[valid], toY(lows[valid]), xValues[valid], toY(highs[valid]))
+    if spacing > width:
+        centres = toY(minMaxs.mean(axis=1))
+        edges = numpy.flatnonzero(numpy.diff(valid.astype(numpy.int8))) + 1
+        for run in numpy.split(numpy.arange(len(columns)), edges):
+            if valid[run[0]]:
+                utils.drawPolyline(painter, xValues[run], centres[run])
+
+
+""" Time axis of a session: sample index <-> time (ns since its first sample), the gaps keep their duration """
+class Timeline():
+    # The samples between two gaps (see session.findGaps) are spread at the period measured over the
+    # received samples, so the axis is exact at every gap and a lookup costs O(log gaps).
+    def __init__(self, source):
+        self.sampleCount = len(source)
+        gaps = [gap for gap in source.getGaps() if 0 < gap[0] < self.sampleCount]
+        self.period = 1e9 / source.nominalRate
+        if self.sampleCount > len(gaps) + 1:
+            span = int(source.times[self.sampleCount - 1]) - int(source.times[0]) - sum(gap[2] for gap in gaps)
+            if span > 0:
+                self.period = span / (self.sampleCount - 1 - len(gaps))
+        # first sample and time of every run of samples between two gaps
+        self.segmentSamples = [0]
+        self.segmentTimes = [0.0]
+        for iSample, missing, duration in gaps:
+            self.segmentTimes.append(self.segmentTimes[-1] + (iSample - 1 - self.segmentSamples[-1]) * self.period + duration)
+            self.segmentSamples.append(iSample)
+
+    """ Measured sample rate (hz), gaps excluded """
+    def getRate(self):
+        return 1e9 / self.period
+
+    """ Time from the first sample to the end of the last one (ns) """
+    def getDuration(self):
+        return self.sampleToTime(self.sampleCount - 1) + self.period if self.sampleCount > 0 else 0
+
+    def sampleToTime(self, iSample):
+        iSegment = max(0, bisect.bisect_right(self.segmentSamples, iSample) - 1)
+        return self.segmentTimes[iSegment] + (iSample - self.segmentSamples[iSegment]) * self.period
+
+    """ Number of samples before the given time, the index of the first sample at or after it """
+    def timeToSample(self, sampleTime):
+        iSegment = bisect.bisect_right(self.segmentTimes, sampleTime) - 1
+        if iSegment < 0:
+            return 0
+        segmentEnd = self.segmentSamples[iSegment + 1] if iSegment + 1 < len(self.segmentSamples) else self.sampleCount
+        return min(segmentEnd, self.segmentSamples[iSegment] + math.ceil((sampleTime - self.segmentTimes[iSegment]) / self.period))
+
+
+""" Zoomable, scrollable bpm / SpO2 timeline of a session (live Session or SessionReader), paint device agnostic """
+class HistoryViewBase():
+    # Shows the time range [viewStart, viewStart + viewSpan) (ns since the first sample, see Timeline),
+    # the right edge sticks to the last sample while following. Wheel zooms around the cursor, dragging
+    # pans, double click goes back live. Columns are read from the min/max pyramids of the session:
+    # painting is O(width) at any zoom.
+    def initView(self, size):
+        self.setMinimumSize(size)
+        self.setSizePolicy(QtWidgets.QSizePolicy.Expanding, QtWidgets.QSizePolicy.Expanding)
+        self.initState()
+
+    """ View state, without any widget, see report.TrendRenderer """
+    def initState(self):
+        self.source = None
+        self.sampleCount = 0
+        self.timeline = None
+        self.windowSeconds = config.dfltMinutes * 60
+        self.viewStart = 0
+        self.viewSpan = 1
+        self.follow = True
+        self.dragPosition = None
+        self.bpmMaxValue = 127
+        self.o2MaxValue = 127
+        self.gridLayer = None  # (key, pixmap)
+        self.timeColLayer = None  # (key, pixmap)
+
+    def sizeHint(self):
+        return self.minimumSize()
+
+    """ Show another session, back to the live window """
+    def setSource(self, source):
+        self.source = source
+        self.sampleCount = 0
+        self.timeline = None
+        self.resetView()
+
+    """ Set the width of the live window (seconds) """
+    def setWindow(self, seconds):
+        self.windowSeconds = seconds
+        self.resetView()
+
+    def resetView(self):
+        self.follow = True
+        self.viewSpan = self.getWindowSpan()
+        self.viewStart = max(0, self.getDuration() - self.viewSpan)
+        self.refresh()
+        self.update()
+
+    """ Width of the live window (ns) """
+    def getWindowSpan(self):
+        return self.windowSeconds * 1e9
+
+    """ Time covered by the session (ns) """
+    def getDuration(self):
+        return self.timeline.getDuration() if self.timeline is not None else 0
+
+    """ Follow the new samples of the session, repaint only when something changed """
+    def refresh(self):
+        if self.source is None:
+            return
+        sampleCount = len(self.source)
+        if sampleCount == self.sampleCount:
+            return
+        self.sampleCount = sampleCount
+        self.timeline = Timeline(self.source)
+        if self.follow:
+            self.viewStart = max(0, self.getDuration() - self.viewSpan)
+            self.update()
+
+    """ Clamp the view to the session (at least 16 samples wide), following when the view reaches the end """
+    def setView(self, start, span):
+        minimumSpan = 16 * self.timeline.period if self.timeline is not None else 0
+        duration = self.getDuration()
+        self.viewSpan = max(minimumSpan, min(span, max(duration, self.getWindowSpan())))
+        self.viewStart = max(0, min(start, duration - self.viewSpan))
+        self.follow = self.viewStart + self.viewSpan >= duration
+        self.update()
+
+    def xToTime(self, x):
+        return self.viewStart + x / self.width() * self.viewSpan
+
+    def timeToX(self, sampleTime):
+        return (sampleTime - self.viewStart) / self.viewSpan * self.width()
+
+    def sampleToX(self, iSample):
+        return self.timeToX(self.timeline.sampleToTime(iSample))
+
+    """ Samples [first, last) of the view """
+    def getViewSamples(self):
+        return (self.timeline.timeToSample(self.viewStart), self.timeline.timeToSample(self.viewStart + self.viewSpan))
+
+    def valueToY(self, value, maxValue):
+        return self.height() - min(value, maxValue) / maxValue * self.height() - 1
+
+    def wheelEvent(self, event):
+        factor = 0.8 ** (event.angleDelta().y() / 120)
+        anchor = self.xToTime(event.pos().x())
+        span = self.viewSpan * factor
+        self.setView(anchor - (anchor - self.viewStart) * span / self.viewSpan, span)
+
+    def mousePressEvent(self, event):
+        self.dragPosition = event.pos().x()
+
+    def mouseMoveEvent(self, event):
+        if self.dragPosition is not None:
+            delta = (self.dragPosition - event.pos().x()) / self.width() * self.viewSpan
+            self.dragPosition = event.pos().x()
+            self.setView(self.viewStart + delta, self.viewSpan)
+
+    def mouseReleaseEvent(self, event):
+        self.dragPosition = None
+
+    def mouseDoubleClickEvent(self, event):
+        self.resetView()
+
+    def render(self, painter):
+        self.drawGrid(painter)
+        if self.source is not None and self.timeline is not None and self.sampleCount > 0:
+            self.drawCurve(painter, self.source.pulseRatePyramid, self.bpmMaxValue, config.bmpColor)
+            self.drawCurve(painter, self.source.spO2Pyramid, self.o2MaxValue, config.o2Color)
+            self.drawEvents(painter)
+
+    """ Drop the cached grid layers, e.g. after a config change """
+    def invalidateGrid(self):
+        self.gridLayer = None
+        self.timeColLayer = None
+
+    """ Create a transparent pixmap matching the device pixel ratio of the view """
+    def createLayer(self, width, height):
+        ratio = self.devicePixelRatioF()
+        layer = QtGui.QPixmap(int(width * ratio), int(height * ratio))
+        layer.setDevicePixelRatio(ratio)
+        layer.fill(QtCore.Qt.transparent)
+        return layer
+
+    """ Static background: bpm lines, the mark 100 and the axis labels, rebuilt only when the size changes """
+    def getGridLayer(self):
+        key = (self.width(), self.height(), self.devicePixelRatioF())
+        if self.gridLayer is not None and self.gridLayer[0] == key:
+            return self.gridLayer[1]
+        layer = self.createLayer(self.width(), self.height())
+        layer.fill(config.dfltBkgColor)
+        painter = QtGui.QPainter(layer)
+        painter.setPen(config.gridLineColor)
+        lineHeight = self.height() / self.bpmMaxValue * config.bpmLineFrequency
+        for iLine in range(int(self.height() / lineHeight) + 1):
+            y = int(self.height() - iLine * lineHeight - 1)
+            painter.drawLine(0, y, self.width(), y)
+        # draw a specific line for the mark 100
+        painter.setPen(config.gridLine100Color)
+        y = int(self.valueToY(100, self.bpmMaxValue))
+        painter.drawLine(0, y, self.width(), y)
+        # axis labels
+        painter.setPen(config.gridColColor)
+        painter.setFont(QtGui.QFont("Arial", 7))
+        for value in range(config.axisLabelFrequency, self.bpmMaxValue + 1, config.axisLabelFrequency):
+            painter.drawText(QtCore.QPointF(2, self.valueToY(value, self.bpmMaxValue) - 2), str(value))
+        painter.end()
+        self.gridLayer = (key, layer)
+        return layer
+
+    """ Time cols every spacing pixels from x = 0, one spacing wider than the view so it can be shifted, rebuilt on zoom / resize """
+    def getTimeColLayer(self, spacing):
+        key = (self.width(), self.height(), self.devicePixelRatioF(), spacing)
+        if self.timeColLayer is not None and self.timeColLayer[0] == key:
+            return self.timeColLayer[1]
+        layer = self.createLayer(int(self.width() + spacing) + 1, self.height())
+        painter = QtGui.QPainter(layer)
+        painter.setPen(config.gridColColor)
+        for iCol in range(int(self.width() / spacing) + 2):
+            x = int(iCol * spacing)
+            painter.drawLine(x, 0, x, self.height())
+        painter.end()
+        self.timeColLayer = (key, layer)
+        return layer
+
+    """ Blit the cached grid and the time cols, which start from the last hold """
+    def drawGrid(self, painter):
+        painter.drawPixmap(0, 0, self.getGridLayer())
+        if self.source is None or self.timeline is None:
+            return
+        holds = [event[0] for event in self.source.getEvents(0, self.getViewSamples()[1]) if event[2] == ReaderEvent.APNEA.value]
+        spacing = config.timeColFrequency * 1e9 / self.viewSpan * self.width()
+        if not holds:
+            return
+        # zoomed out, keep one col every few timeColFrequency instead of a solid block
+        spacing *= math.ceil(8 / spacing)
+        # quantize the spacing so the layer survives zoom steps that don't change it visibly
+        spacing = round(spacing, 1)
+        holdX = self.sampleToX(holds[-1])
+        firstX = holdX + max(0, math.ceil(-holdX / spacing)) * spacing
+        painter.save()
+        painter.setClipRect(QtCore.QRectF(max(0, holdX), 0, self.width(), self.height()), QtCore.Qt.IntersectClip)
+        painter.drawPixmap(QtCore.QPointF(int(firstX), 0), self.getTimeColLayer(spacing))
+        painter.restore()
+
+    """ Draw a curve through the min / max of every column, one polyline per run of non empty columns (broken by the gaps) """
+    def drawCurve(self, painter, curvePyramid, maxValue, color):
+        count = max(1, min(self.width(), int(self.viewSpan / self.timeline.period)))
+        step = self.viewSpan / count
+        columns = curvePyramid.getColumnsBetween([self.timeline.timeToSample(self.viewStart + iColumn * step) for iColumn in range(count + 1)])
+        drawColumns(painter, columns, QtCore.QRectF(0, 0, self.width(), self.height()), maxValue, color)
+
+    """ Draw the event lines at their exact sample """
+    def drawEvents(self, painter):
+        for iSample, eventTime, eventValue in self.source.getEvents(*self.getViewSamples()):
+            if eventValue in eventColors:
+                painter.setPen(QtGui.QPen(eventColors[eventValue], config.curvePixelSize + 2))
+                x = self.sampleToX(iSample)
+                painter.drawLine(QtCore.QLineF(x, 0, x, self.height()))
+
+
+""" History view painted by the CPU """
+class HistoryView(HistoryViewBase, QtWidgets.QWidget):
+    def __init__(self, size, parent=None):
+        QtWidgets.QWidget.__init__(self, parent)
+        self.initView(size)
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        self.render(painter)
+        painter.end()
+
+
+""" Sweeping pulse waveform of a session, rendered into an offscreen image """
+class PulseView(QtWidgets.QWidget):
+    # Pixel p shows the sample p * decimation at x = p % width, a blank band sweeps ahead of the
+    # last pixel. New samples are drawn incrementally; a resize (or a new decimation) re-renders
+    # the retained history at the new size in a background thread, the previous image is shown
+    # stretched meanwhile and the new one is swapped in once ready. A single render thread runs at
+    # a time, it only renders the latest request (a window resize sends many of them).
+    rendered = QtCore.Signal(object, object)
+
+    def __init__(self, size, parent=None):
+        QtWidgets.QWidget.__init__(self, parent)
+        self.setMinimumSize(size)
+        self.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Expanding)
+        self.source = None
+        self.rateMeter = None
+        self.sourceRate = None
+        self.pulseMaxValue = 100
+        self.decimation = 2
+        self.image = None
+        self.lastPixel = -1
+        self.generation = 0
+        self.renderPending = False
+        self.renderLock = Lock()
+        self.renderRequest = None  # (key, source, size) not picked by the render thread yet
+        self.rendering = False  # the render thread runs
+        self.paused = False
+        self.rendered.connect(self.swapImage)
+
+    def sizeHint(self):
+        return self.minimumSize()
+
+    """ Show a session, the sweep follows the rate measured by rateMeter (sampleclock.RateMeter) while it's live """
+    def setSource(self, source, rateMeter=None):
+        self.source = source
+        self.rateMeter = rateMeter
+        self.sourceRate = Timeline(source).getRate() if source is not None and rateMeter is None else None
+        self.requestRender()
+
+    """ Samples per pixel, following the measured rate of the source """
+    def getDecimation(self):
+        if self.source is None:
+            return self.decimation
+        return getPulseDecimation(self.rateMeter.getRate() if self.rateMeter is not None else self.sourceRate)
+
+    """ Re-render the whole history at the current size in a background thread, replaces a request not started yet """
+    def requestRender(self):
+        self.generation += 1
+        self.renderPending = True
+        self.decimation = self.getDecimation()
+        with self.renderLock:
+            self.renderRequest = ((self.generation, self.decimation), self.source, self.size())
+            if self.rendering:
+                return
+            self.rendering = True
+        Thread(target=self.renderRequests, daemon=True).start()
+
+    """ Render thread: render the latest request until there is none left """
+    def renderRequests(self):
+        try:
+            while True:
+                with self.renderLock:
+                    request, self.renderRequest = self.renderRequest, None
+                    if request is None:
+                        self.rendering = False
+                        return
+                self.renderHistory(*request)
+        except Exception:
+            # the next request starts a new thread
+            with self.renderLock:
+                self.rendering = False
+            raise
+
+    def renderHistory(self, key, source, size):
+        image = QtGui.QImage(size, QtGui.QImage.Format_RGB32)
+        image.fill(config.dfltBkgColor)
+        lastPixel = -1
+        if source is not None and len(source) > 0:
+            lastPixel = (len(source) - 1) // key[1]
+            firstPixel = max(0, lastPixel - size.width() + self.getBandWidth(size.width()) + 1)
+            self.drawPixels(image, source, key[1], firstPixel, lastPixel)
+        self.rendered.emit(key, (image, lastPixel))
+
+    """ Swap a background render in, unless a newer one was requested meanwhile """
+    def swapImage(self, key, result):
+        if key[0] != self.generation:
+            return
+        self.image, self.lastPixel = result
+        self.renderPending = False
+        self.refresh()
+        self.update()
+
+    def getBandWidth(self, width):
+        return int(width * 0.2)
+
+    """ Pause the sweep under CPU pressure, it resumes from the last sample """
+    def setReducedDetail(self, enable):
+        self.paused = enable
+
+    """ Draw the new samples of the source """
+    def refresh(self):
+        if self.source is None or self.image is None or self.renderPending or self.paused:
+            return
+        if self.getDecimation() != self.decimation:
+            self.requestRender()
+            return
+        lastPixel = (len(self.source) - 1) // self.decimation
+        if lastPixel > self.lastPixel:
+            self.drawPixels(self.image, self.source, self.decimation, max(self.lastPixel + 1, lastPixel - self.image.width() + 1), lastPixel)
+            self.lastPixel = lastPixel
+            self.update()
+
+    """ Draw the pixels [firstPixel, lastPixel] and clear the band ahead of the last one """
+    def drawPixels(self, image, source, decimation, firstPixel, lastPixel):
+        width = image.width()
+        height = image.height()
+        painter = QtGui.QPainter(image)
+        drawPulsePixels(painter, source, decimation, width, height, firstPixel, lastPixel, self.pulseMaxValue)
+        # clean the band ahead
+        bandStart = (lastPixel + 1) % width
+        bandWidth = self.getBandWidth(width)
+        painter.fillRect(bandStart, 0, bandWidth, height, config.dfltBkgColor)
+        if bandStart + bandWidth > width:
+            painter.fillRect(0, 0, bandStart + bandWidth - width, height, config.dfltBkgColor)
+        painter.end()
+
+    def resizeEvent(self, event):
+        self.requestRender()
+
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        if self.image is None:
+            painter.fillRect(self.rect(), config.dfltBkgColor)
+        else:
+            painter.drawImage(self.rect(), self.image)
+        painter.end()
@@ -0,0 +1,156 @@
+"""*************************************************************************
+*                                                                          *
+* Copyright (C) Nicolas Chaverou - All Rights Reserved.                    *
+*                                                                          *
+*************************************************************************"""
+
+#**************************************************************************
+#! @file workers.py
+#  @brief Acquisition of groups of devices in worker processes
+#
+#  Threads of one process share the GIL: with many devices the reads, the
+#  decoding and the rendering compete for it. Here every group of devices
+#  is read and decoded in a worker process (a pipeline per device) which
+#  publishes the record batches in the ring of the device on the sample bus
+#  (see samplebus.py) and only sends the indexes of the updated devices over
+#  a pipe, every workerNotifyPeriod. The ui process copies the new records from the rings
+#  into the sessions it shows and records.
+#**************************************************************************
+
+#!/usr/bin/env python3
+import multiprocessing
+import multiprocessing.connection
+from threading import Thread, Lock
+import config
+import session
+import pipeline
+import samplebus
+import supervisor
+import sampleclock
+from acquisition import createDriver
+
+""" Worker process: read and decode a group of devices, publish their batches in their ring, notify the updates """
+def runWorker(devices, connection, stopEvent):
+    updated = set()
+    lock = Lock()
+    rings = [samplebus.SampleRing(port) for port, version in devices]
+    threads = []
+    for iDevice, (port, version) in enumerate(devices):
+        driver = createDriver(version)
+        try:
+            driver.connect(port)
+        except Exception:
+            pass  # the supervisor keeps opening the port, see supervisor.supervise
+        if not driver.isConnected() and not config.autoReconnect:
+            rings[iDevice].setActive(False)
+            continue
+
+        def publish(records, iDevice=iDevice, driver=driver):
+            rings[iDevice].write(records, driver.rateMeter)
+            with lock:
+                updated.add(iDevice)
+        source = supervisor.supervise(driver, port, lambda: not stopEvent.is_set())
+        devicePipeline = pipeline.Pipeline(source, [pipeline.Sink('ring', publish, config.sessionQueueSize, pipeline.QueuePolicy.BLOCK)])
+
+        def run(devicePipeline=devicePipeline, driver=driver, ring=rings[iDevice]):
+            devicePipeline.run(lambda: not stopEvent.is_set())
+            driver.disconnect()
+            ring.setActive(False)
+        threads.append(Thread(target=run, daemon=True))
+    for thread in threads:
+        thread.start()
+    while True:
+        running = any(thread.is_alive() for thread in threads)
+        stopEvent.wait(config.workerNotifyPeriod)
+        with lock:
+            pending, updated = updated, set()
+        if pending:
+            connection.send(sorted(pending))
+        if not running:
+            break
+    connection.send(None)
+    connection.close()
+    for ring in rings:
+        ring.close()
+
+
+""" A device acquired in a worker process, same interface as acquisition.DeviceReader """
+class ProcessReader():
+    def __init__(self, port, version, name=None):
+        self.port = port
+        self.version = version
+        self.deviceName = name if name is not None else port
+        self.ring = samplebus.SampleRing(self.deviceName, config.sampleBusSize)
+        self.readCount = 0
+        self.lost = 0  # records overwritten in the ring before they were copied
+        self.threadActive = True
+        nominalRate = createDriver(version).sampleRate
+        self.rateMeter = sampleclock.RateMeter(nominalRate)
+        self.session = session.Session(version.value, nominalRate, session.defaultSessionPath(self.deviceName) if config.recordSession else None)
+
+    """ Health of the stream, from the rate meter of the worker """
+    def getHealth(self):
+        writeCount, interval, lastArrival, active = self.ring.getState()
+        if not active or lastArrival == 0:
+            return sampleclock.RateHealth.STALLED
+        self.rateMeter.interval = interval
+        self.rateMeter.lastArrival = lastArrival
+        return self.rateMeter.getHealth()
+
+    """ Copy the new records of the ring into the session """
+    def pull(self):
+        records, self.readCount, lost = self.ring.read(self.readCount)
+        self.lost += lost
+        if len(records):
+            self.session.addRecords(records)
+
+    def close(self):
+        self.pull()
+        self.threadActive = False
+        self.session.close()
+        self.ring.close()
+
+
+""" Devices acquired by processCount worker processes, their batches collected by a thread of this process """
+class WorkerPool():
+    def __init__(self, devices, processCount):
+        self.readers = [ProcessReader(port, version) for port, version in devices]
+        self.stopEvent = multiprocessing.Event()
+        self.groups = dict()  # receiving end of the pipe of a worker: its readers
+        self.processes = []
+        for iProcess in range(min(processCount, len(self.readers))):
+            readers = self.readers[iProcess::processCount]
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            self.processes.append(multiprocessing.Process(target=runWorker, daemon=True,
+                                  args=([(reader.port, reader.version) for reader in readers], sender, self.stopEvent)))
+            self.groups[receiver] = (readers, sender)
+        self.collector = Thread(target=self.collect, daemon=True)
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+        for readers, sender in self.groups.values():
+            sender.close()
+        self.collector.start()
+
+    """ Collector thread: copy the updated rings into their session until every worker is done """
+    def collect(self):
+        pending = dict((receiver, readers) for receiver, (readers, sender) in self.groups.items())
+        while pending:
+            for receiver in multiprocessing.connection.wait(list(pending)):
+                try:
+                    message = receiver.recv()
+                except EOFError:
+                    message = None
+                if message is None:
+                    for reader in pending.pop(receiver):
+                        reader.close()
+                    continue
+                for iDevice in message:
+                    pending[receiver][iDevice].pull()
+
+    def stop(self):
+        self.stopEvent.set()
+        for process in self.processes:
+            process.join()
+        self.collector.join()